@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+try:
+    import backupFiles
+except ImportError:
+    raise ImportError('BackupFiles needs to be in the same folder or in an importable path!')
+
+# Benchmarks backupFiles.backup() on generated folders. Every run with the same seed and scale generates the same files,
+# so results of different versions/machines can be compared. Results are written as json.
+
+# tinyFiles, tinySize, hugeFiles, hugeSize, depth (nested folders)
+scales = {
+    "small": {"tinyFiles": 2000, "tinySize": 4*1024, "hugeFiles": 2, "hugeSize": 16*1024*1024, "depth": 8},
+    "medium": {"tinyFiles": 20000, "tinySize": 4*1024, "hugeFiles": 4, "hugeSize": 128*1024*1024, "depth": 16},
+    "large": {"tinyFiles": 100000, "tinySize": 8*1024, "hugeFiles": 8, "hugeSize": 512*1024*1024, "depth": 24},
+}
+# backup() options of each mode
+modes = {
+    "zip": {},
+    "incremental": {"incremental": True},
+    "zst": {"archiveFormat": "zst"},
+    "cas": {"storage": "cas"},
+}
+scenarios = ["initial", "noChange", "oneFile", "churn10"]
+# functions of backupFiles that belong to a phase, nested calls are only counted once
+phases = {
+    "compare": ["detectChanges", "buildManifest"],
+    "archive": ["createArchive", "createFullArchive", "createIncrementalArchive", "createCasVersion"],
+    "copy": ["copyToTemp", "updateTemp"],
+    "prune": ["checkVersionLimit", "collectGarbage"],
+}
+words = [b"stone", b"tree", b"zombie", b"server", b"player", b"chunk", b"inventory", b"health", b"quest", b"map"]
+
+
+def readIoCounters() -> dict:
+    # bytes read/written by this process (all threads). /proc/self/io on linux, psutil elsewhere if installed
+    try:
+        with open("/proc/self/io", "r") as f:
+            values = dict(line.split(": ") for line in f.read().splitlines())
+        return {"read": int(values["rchar"]), "written": int(values["wchar"])}
+    except (OSError, KeyError, ValueError):
+        pass
+    try:
+        import psutil
+        counters = psutil.Process().io_counters()
+        return {"read": counters.read_bytes, "written": counters.write_bytes}
+    except Exception:
+        return {"read": 0, "written": 0}
+
+
+def fileContent(rng: random.Random, size: int, kind: str) -> bytes:
+    if kind == "random":
+        return rng.randbytes(size)
+    if kind == "zeros":
+        return bytes(size)
+    # text like data, compresses well
+    data = bytearray()
+    while len(data) < size:
+        data += rng.choice(words) + b" "
+    return bytes(data[:size])
+
+
+def generateTree(root: str, scale: dict, seed: int) -> list:
+    # many tiny files in a few folders, a deep chain of nested folders and a few huge files with mixed compressibility
+    rng = random.Random(seed)
+    files = []
+    kinds = ["text", "random", "zeros"]
+    for i in range(scale["tinyFiles"]):
+        folder = os.path.join(root, "tiny", f"d{i % 100:03}")
+        files.append((os.path.join(folder, f"f{i:06}.dat"), rng.randint(1, scale["tinySize"]), rng.choice(kinds)))
+    deep = os.path.join(root, "deep")
+    for level in range(scale["depth"]):
+        deep = os.path.join(deep, f"level{level}")
+        files.append((os.path.join(deep, "data.txt"), rng.randint(1, 64*1024), "text"))
+    for i in range(scale["hugeFiles"]):
+        files.append((os.path.join(root, "huge", f"world{i}.sav"), scale["hugeSize"], kinds[i % 2]))
+    for path, size, kind in files:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        writeFile(path, rng, size, kind)
+    return [path for path, _, _ in files]
+
+
+def writeFile(path: str, rng: random.Random, size: int, kind: str):
+    with open(path, "wb") as f:
+        remaining = size
+        while remaining > 0:
+            block = min(remaining, 8*1024*1024)
+            f.write(fileContent(rng, block, kind))
+            remaining -= block
+
+
+def mutate(scenario: str, files: list, rng: random.Random):
+    # changes the tree for the scenario, the mtime is moved forward so a change is seen even within the same timestamp tick
+    if scenario in ("initial", "noChange"):
+        return
+    if scenario == "oneFile":
+        changed = [rng.choice(files)]
+    else:
+        changed = rng.sample(files, max(1, len(files) // 10))
+    for path in changed:
+        size = min(os.path.getsize(path), 1024*1024) or 1
+        with open(path, "r+b") as f:
+            f.seek(rng.randint(0, max(0, size - 16)))
+            f.write(rng.randbytes(16))
+        st = os.stat(path)
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+    if scenario == "churn10":
+        # a few added and deleted files as well
+        for path in rng.sample(files, max(1, len(files) // 100)):
+            if os.path.exists(path) and path not in changed:
+                os.remove(path)
+        for i in range(max(1, len(files) // 100)):
+            path = os.path.join(os.path.dirname(files[0]), f"added{rng.randint(0, 1 << 30)}_{i}.dat")
+            writeFile(path, rng, rng.randint(1, 4096), "text")
+
+
+class PhaseRecorder:
+    # wraps the phase functions of backupFiles to measure time and io of each phase. The files handled per phase
+    # come from the BackupMetrics of the backup() call
+    def __init__(self):
+        self.results = {}
+        self.depth = 0
+        self.originals = {}
+        self.metrics = None
+
+    def install(self):
+        for phase, names in phases.items():
+            for name in names:
+                original = getattr(backupFiles, name)
+                self.originals[name] = original
+                setattr(backupFiles, name, self._wrap(phase, original))
+        recorder = self
+        original = backupFiles.BackupMetrics
+        self.originals["BackupMetrics"] = original
+
+        class CapturedMetrics(original):
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                recorder.metrics = self
+        backupFiles.BackupMetrics = CapturedMetrics
+
+    def uninstall(self):
+        for name, original in self.originals.items():
+            setattr(backupFiles, name, original)
+
+    def reset(self):
+        self.results = {phase: {"seconds": 0.0, "calls": 0, "bytesRead": 0, "bytesWritten": 0} for phase in phases}
+        self.metrics = None
+
+    def phaseFiles(self, phase: str) -> int:
+        # files compared, copied or archived (archives deleted for prune)
+        if self.metrics is None:
+            return 0
+        return self.metrics.phases.get(phase, {}).get("files", 0)
+
+    def _wrap(self, phase: str, function):
+        def wrapper(*args, **kwargs):
+            if self.depth:
+                return function(*args, **kwargs)
+            self.depth += 1
+            ioBefore = readIoCounters()
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                ioAfter = readIoCounters()
+                result = self.results[phase]
+                result["seconds"] += time.perf_counter() - started
+                result["calls"] += 1
+                result["bytesRead"] += ioAfter["read"] - ioBefore["read"]
+                result["bytesWritten"] += ioAfter["written"] - ioBefore["written"]
+                self.depth -= 1
+        return wrapper
+
+
+def runMode(workDir: str, mode: str, scale: dict, seed: int, recorder: PhaseRecorder, verbose: bool) -> list:
+    root = os.path.join(workDir, mode)
+    source = os.path.join(root, "source")
+    base = os.path.join(root, "base")
+    shutil.rmtree(root, ignore_errors=True)
+    files = generateTree(source, scale, seed)
+    rng = random.Random(seed + 1)
+    results = []
+    for scenario in scenarios:
+        mutate(scenario, files, rng)
+        fileCount = len(backupFiles.scanTree(source))
+        recorder.reset()
+        ioBefore = readIoCounters()
+        started = time.perf_counter()
+        output = io.StringIO()
+        with contextlib.redirect_stdout(sys.stdout if verbose else output):
+            backupFiles.backup(base, source, "bench", versionsToKeep=10, **modes[mode])
+        wall = time.perf_counter() - started
+        ioAfter = readIoCounters()
+        for name, phase in recorder.results.items():
+            phase["files"] = recorder.phaseFiles(name)
+            phase["filesPerSecond"] = phase["files"] / phase["seconds"] if phase["seconds"] and phase["files"] else None
+        results.append({"mode": mode, "scenario": scenario, "files": fileCount, "wallSeconds": wall,
+                        "bytesRead": ioAfter["read"] - ioBefore["read"], "bytesWritten": ioAfter["written"] - ioBefore["written"],
+                        "filesPerSecond": fileCount / wall if wall else None, "phases": recorder.results})
+        print(f"{mode:<12} {scenario:<9} {wall:8.3f}s  read {results[-1]['bytesRead'] / 2**20:9.1f} MiB  "
+              f"written {results[-1]['bytesWritten'] / 2**20:9.1f} MiB  " +
+              "  ".join(f"{phase} {r['seconds']:.3f}s" for phase, r in recorder.results.items()), file=sys.stderr)
+    shutil.rmtree(root, ignore_errors=True)
+    return results
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmarks backupFiles.backup() on generated folders and prints the results as json")
+    parser.add_argument("--workDir", '-w', help="folder for the generated data (default: a temporary folder)")
+    parser.add_argument("--scale", '-s', choices=list(scales), default="small", help="size of the generated folder")
+    parser.add_argument("--seed", type=int, default=1, help="same seed and scale generate the same files")
+    parser.add_argument("--modes", '-m', default=",".join(modes), help=f"comma separated list of {', '.join(modes)}")
+    parser.add_argument("--output", '-o', help="write the json results to this file instead of stdout")
+    parser.add_argument("--verbose", '-v', action="store_true", help="show the output of backupFiles")
+    args = parser.parse_args()
+
+    selected = args.modes.split(",")
+    for mode in selected:
+        if mode not in modes:
+            parser.error(f"unknown mode {mode}")
+    workDir = args.workDir or tempfile.mkdtemp(prefix="backupBenchmark")
+    recorder = PhaseRecorder()
+    recorder.install()
+    results = []
+    try:
+        for mode in selected:
+            try:
+                results += runMode(workDir, mode, scales[args.scale], args.seed, recorder, args.verbose)
+            except ImportError as e:
+                # zst without zstandard module or binary
+                print(f"skipping {mode}: {e}", file=sys.stderr)
+    finally:
+        recorder.uninstall()
+        if not args.workDir:
+            shutil.rmtree(workDir, ignore_errors=True)
+
+    report = {"meta": {"scale": args.scale, "seed": args.seed, "python": platform.python_version(), "platform": platform.platform(),
+                       "cpus": os.cpu_count(), "time": time.strftime("%Y-%m-%dT%H:%M:%S")},
+              "results": results}
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
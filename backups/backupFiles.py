@@ -1,34 +1,131 @@
 #!/usr/bin/env python3
 import argparse
+import contextlib
+import errno
 import shutil
 import os
 import filecmp
+import hashlib
+import io
+import json
+import lzma
+import struct
+import subprocess
+import tarfile
+import time
+import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from datetime import datetime
 from pathlib import Path
-from typing import List
-import arrow
+from typing import Dict, List
 import sys
+import threading
 try:
     import tkinter
     from tkinter import messagebox
 except ImportError:
     pass
+# only available on linux/mac, used to clone files on filesystems with reflinks (btrfs, xfs)
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+# optional, used for zst/lz4 archives. Without them the zstd/lz4 command line tools are used
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame as lz4frame
+except ImportError:
+    lz4frame = None
 
 tmpFolder = "/BackupTemp/"
 backupFolder = "/Backup/"
+# stored next to BackupTemp/<name>, remembers size/mtime/inode/hash of every file of the last backup
+manifestSuffix = ".manifest.json"
+manifestVersion = 1
+hashBlockSize = 1024*1024
+# incremental mode: a full archive followed by delta archives that only hold the changed files
+fullSuffix = "_full"
+deltaSuffix = "_delta"
+deltaInfoName = ".backup-delta.json"
+archiveTimeFormat = "%Y_%m_%d_%H_%M_%S"
+# list of the archives of a backup with their time and size, stored as base/Backup/name.catalog.json
+catalogSuffix = ".catalog.json"
+# metrics of each backup, see BackupMetrics
+metricsLock = threading.Lock()
+phaseCounters = threading.local()
+prometheusHelp = {
+    "backup_last_run_timestamp_seconds": "Start of the last backup run",
+    "backup_last_success": "1 if the last backup run succeeded",
+    "backup_last_changed": "1 if the last backup run found changes and archived them",
+    "backup_duration_seconds": "Duration of the last backup run",
+    "backup_archived_bytes": "Uncompressed bytes archived by the last backup run",
+    "backup_archive_bytes": "Bytes written to archives/chunks by the last backup run",
+    "backup_compression_ratio": "Archived bytes divided by written bytes of the last backup run",
+    "backup_phase_duration_seconds": "Duration of a phase (compare, copy, archive, prune) of the last backup run",
+    "backup_phase_files": "Files handled by a phase of the last backup run",
+    "backup_phase_bytes": "Bytes handled by a phase of the last backup run",
+}
+# content addressed storage: base/Chunks holds every unique chunk once (shared by all backup names),
+# base/Backup/name/date.cas.json describes one version
+chunkFolder = "/Chunks/"
+casSuffix = ".cas.json"
+chunkMinSize = 256*1024
+chunkMaxSize = 4*1024*1024
+# content defined chunking: a chunk ends at the first position after chunkMinSize where the rolling hash of the last
+# chunkWindow bytes (a Rabin fingerprint, crc32) has all bits of chunkCutMask zero. Boundaries only depend on the
+# bytes before them, so they survive inserted or removed bytes. The hash is only computed where the last bytes,
+# translated to one bit each by chunkBits, read chunkCandidate (every 64th byte of random data). Those positions are
+# found in C by translate and find, a pure python rolling hash would be far slower than the disk. On average a chunk
+# ends 1MiB after chunkMinSize (text included), data made of only a few different bytes may never show chunkCandidate
+# and is cut at chunkMaxSize. Changing any of these re-chunks all files once
+chunkWindow = 64
+chunkBits = bytes(b"01"[hashlib.sha256(bytes([i])).digest()[0] & 1] for i in range(256))
+chunkCandidate = b"100110"
+chunkCutMask = (1 << 14) - 1
+chunkScanSize = 256*1024
+# chunks touched within this time are never garbage collected, protects chunks of a backup running in parallel
+chunkGraceSeconds = 6*60*60
+# archive formats: zip (deflate, members compressed on a thread pool) or tar compressed by zstd, lz4 or xz
+archiveExtensions = {"zip": ".zip", "zst": ".tar.zst", "lz4": ".tar.lz4", "xz": ".tar.xz"}
+defaultCompressLevels = {"zip": 6, "zst": 3, "lz4": 0, "xz": 6}
+compressBinaries = {"zst": "zstd", "lz4": "lz4", "xz": "xz"}
+compressModules = {"zst": "zstandard", "lz4": "lz4", "xz": "lzma"}
+compressBlockSize = 1024*1024
+compressSampleSize = 64*1024
+zip64Limit = 0xFFFFFFFF
+# consistent capture: a file that changed while being copied is copied again, up to captureRetries times
+captureRetries = 3
+captureRetryDelay = 0.5
+FICLONE = 0x40049409
+# devices where cloning failed once, no need to try again
+reflinkUnsupported = set()
+# copy engine: number of files copied at the same time, the kernel does the copying where possible
+copyThreads = 8
+copyChunkSize = 64*1024*1024
+copyFileRangeUnsupported = set()
+# already compressed formats, stored without compression in zip archives
+incompressibleSuffixes = {".zip", ".7z", ".rar", ".gz", ".tgz", ".bz2", ".xz", ".zst", ".lz4", ".jpg", ".jpeg", ".png", ".webp",
+                          ".gif", ".mp3", ".ogg", ".opus", ".mp4", ".mkv", ".webm", ".pak", ".jar", ".br"}
 
 
 def CheckDiskUsage(path: str):
-    base = path
-    if '\\' in base:
-        base = base.split('\\')[0]
-    if '/' in base:
-        base = base.split('/')[0]
+    # disk_usage needs an existing path on the disk, the backup folders may not exist yet
+    base = Path(path).absolute()
+    while not base.exists() and base != base.parent:
+        base = base.parent
     total, used, free = shutil.disk_usage(base)
     if used/total > 0.95:
         print(
             f"Disk is nearly full({int((used/total)*100)}). please check or adjust backup limits!")
-        # try creating a window to notify user
+        # try creating a window to notify user, tkinter only works from the main thread
+        if threading.current_thread() is not threading.main_thread():
+            return
         try:
             rootWindow = tkinter.Tk()
             rootWindow.withdraw()
@@ -38,32 +135,252 @@ def CheckDiskUsage(path: str):
             pass
 
 
-def make_archive(destPath: str, src: str):
-    now = datetime.now()
-    dt_string = now.strftime("%Y_%m_%d_%H_%M_%S")
-    if Path(src).is_dir():
-        shutil.make_archive(destPath+"/"+dt_string, 'zip', src)
-    else:
-        shutil.make_archive(destPath+"/"+dt_string, 'zip',
-                            Path(src).parent, Path(src).name)
+class ParallelZipWriter:
+    # writes a zip file member by member into fileobj. Members are split into blocks that are deflated on a thread pool
+    # (zlib releases the GIL) and joined into one deflate stream like pigz does. Needs a seekable fileobj, the header of
+    # each member is patched after its data is written, so nothing is staged in memory or on disk.
+    def __init__(self, fileobj, level: int, threads: int):
+        self.fileobj = fileobj
+        self.level = level
+        self.threads = threads
+        self.entries = []
+
+    def addFiles(self, members: List[tuple]):
+        # members: list of (arcName, path)
+        pending = deque()
+        window = self.threads * 4
+        with ThreadPoolExecutor(max_workers=self.threads) as pool:
+            for task in self._tasks(members, pool):
+                pending.append(task)
+                while len(pending) > window:
+                    self._handle(pending.popleft())
+            while pending:
+                self._handle(pending.popleft())
+
+    def writeStr(self, arcName: str, data: bytes):
+        entry = self._begin(arcName, len(data), zipfile.ZIP_DEFLATED, time.time(), 0o644)
+        compressed = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        self._write(entry, compressed.compress(data) + compressed.flush())
+        entry["crc"] = zlib.crc32(data)
+        entry["usize"] = len(data)
+        self._end(entry)
+
+    def addDir(self, arcName: str, st: os.stat_result):
+        entry = self._begin(arcName.rstrip("/") + "/", 0, zipfile.ZIP_STORED, st.st_mtime, st.st_mode)
+        self._end(entry)
+
+    def close(self):
+        cdOffset = self.fileobj.tell()
+        for entry in self.entries:
+            extra = b""
+            usize, csize, offset = entry["usize"], entry["csize"], entry["offset"]
+            if usize >= zip64Limit or csize >= zip64Limit or offset >= zip64Limit:
+                extra = struct.pack("<HHQQQ", 1, 24, usize, csize, offset)
+                usize = csize = offset = 0xFFFFFFFF
+            self.fileobj.write(struct.pack("<IHHHHHHIIIHHHHHII", 0x02014b50, 45 | (3 << 8), 45, entry["flags"], entry["method"],
+                                           entry["time"], entry["date"], entry["crc"], csize, usize, len(entry["name"]),
+                                           len(extra), 0, 0, 0, (entry["mode"] & 0xFFFF) << 16, offset))
+            self.fileobj.write(entry["name"])
+            self.fileobj.write(extra)
+        cdEnd = self.fileobj.tell()
+        count = len(self.entries)
+        if count >= 0xFFFF or cdOffset >= zip64Limit or cdEnd - cdOffset >= zip64Limit:
+            self.fileobj.write(struct.pack("<IQHHIIQQQQ", 0x06064b50, 44, 45, 45, 0, 0, count, count, cdEnd - cdOffset, cdOffset))
+            self.fileobj.write(struct.pack("<IIQI", 0x07064b50, 0, cdEnd, 1))
+            self.fileobj.write(struct.pack("<IHHHHIIH", 0x06054b50, 0, 0, 0xFFFF, 0xFFFF, 0xFFFFFFFF, 0xFFFFFFFF, 0))
+        else:
+            self.fileobj.write(struct.pack("<IHHHHIIH", 0x06054b50, 0, 0, count, count, cdEnd - cdOffset, cdOffset, 0))
+
+    def _tasks(self, members: List[tuple], pool):
+        # reading and crc32 happen in order on this thread, only the compression runs on the pool
+        for arcName, path in members:
+            st = os.stat(path)
+            with open(path, "rb") as f:
+                block = f.read(compressBlockSize)
+                method = zipfile.ZIP_STORED if isIncompressible(path, block) else zipfile.ZIP_DEFLATED
+                entry = {"arcName": arcName, "size": st.st_size, "method": method, "mtime": st.st_mtime, "mode": st.st_mode, "crc": 0, "usize": 0}
+                yield ("begin", entry)
+                while True:
+                    nextBlock = f.read(compressBlockSize)
+                    entry["crc"] = zlib.crc32(block, entry["crc"])
+                    entry["usize"] += len(block)
+                    if method == zipfile.ZIP_STORED:
+                        yield ("data", block)
+                    else:
+                        yield ("data", pool.submit(deflateBlock, block, self.level, not nextBlock))
+                    if not nextBlock:
+                        break
+                    block = nextBlock
+            yield ("end", entry)
+
+    def _handle(self, task):
+        kind, value = task
+        if kind == "begin":
+            self.current = self._begin(value["arcName"], value["size"], value["method"], value["mtime"], value["mode"])
+            self.currentSource = value
+        elif kind == "data":
+            self._write(self.current, value if isinstance(value, bytes) else value.result())
+        else:
+            self.current["crc"] = self.currentSource["crc"]
+            self.current["usize"] = self.currentSource["usize"]
+            self._end(self.current)
+
+    def _begin(self, arcName: str, size: int, method: int, mtime: float, mode: int) -> dict:
+        name = arcName.replace(os.sep, "/").encode("utf-8")
+        flags = 0x800 if not arcName.isascii() else 0
+        dt = time.localtime(max(mtime, 315532800))
+        entry = {"name": name, "flags": flags, "method": method, "mode": mode, "offset": self.fileobj.tell(),
+                 "time": (dt.tm_hour << 11) | (dt.tm_min << 5) | (dt.tm_sec // 2),
+                 "date": ((dt.tm_year - 1980) << 9) | (dt.tm_mon << 5) | dt.tm_mday,
+                 # compressed data of incompressible content can be a little bigger than the file itself
+                 "zip64": size >= zip64Limit // 2, "crc": 0, "csize": 0, "usize": 0}
+        extra = struct.pack("<HHQQ", 1, 16, 0, 0) if entry["zip64"] else b""
+        self.fileobj.write(struct.pack("<IHHHHHIIIHH", 0x04034b50, 45, flags, method, entry["time"], entry["date"],
+                                       0, 0, 0, len(name), len(extra)))
+        self.fileobj.write(name)
+        self.fileobj.write(extra)
+        return entry
+
+    def _write(self, entry: dict, data: bytes):
+        self.fileobj.write(data)
+        entry["csize"] += len(data)
+
+    def _end(self, entry: dict):
+        if not entry["zip64"] and (entry["csize"] >= zip64Limit or entry["usize"] >= zip64Limit):
+            raise ValueError(f"{entry['name']} grew over 4GiB while being archived")
+        end = self.fileobj.tell()
+        self.fileobj.seek(entry["offset"] + 14)
+        if entry["zip64"]:
+            self.fileobj.write(struct.pack("<III", entry["crc"], 0xFFFFFFFF, 0xFFFFFFFF))
+            self.fileobj.seek(entry["offset"] + 30 + len(entry["name"]) + 4)
+            self.fileobj.write(struct.pack("<QQ", entry["usize"], entry["csize"]))
+        else:
+            self.fileobj.write(struct.pack("<III", entry["crc"], entry["csize"], entry["usize"]))
+        self.fileobj.seek(end)
+        self.entries.append(entry)
+
+
+def deflateBlock(block: bytes, level: int, last: bool) -> bytes:
+    # blocks end on a byte boundary (sync flush), so the blocks of one file can be concatenated to a valid deflate stream
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def isIncompressible(path: str, sample: bytes) -> bool:
+    # known packed formats are stored right away, everything else is decided by compressing a sample
+    if Path(path).suffix.lower() in incompressibleSuffixes:
+        return True
+    sample = sample[:compressSampleSize]
+    if len(sample) < 4096:
+        return False
+    return len(zlib.compress(sample, 1)) > len(sample) * 0.97
 
 
-def checkFileDate(files: List[Path], daysToKeep: int):
-    oldesDate = arrow.now().shift(days=-int(daysToKeep))
-    for f in files:
-        if f.is_file():
-            item_time = arrow.get(f.stat().st_mtime)
-            if item_time < oldesDate:
-                os.remove(f)
+def compressionThreads(threads: int) -> int:
+    if threads and threads > 0:
+        return threads
+    return os.cpu_count() or 1
 
 
-def checkFileCount(files: List[Path], versionsToKeep: int):
-    maxFiles = int(versionsToKeep)
-    if len(files) > maxFiles:
-        for i in range(0, len(files)-maxFiles):
-            oldestFile = files[i]
-            if oldestFile.is_file():
-                os.remove(oldestFile)
+def tarCompressor(archiveFormat: str, fileobj, level: int, threads: int):
+    # returns (stream to write the tar into, function to finish the stream). Uses the python modules zstandard/lz4
+    # if they are installed, otherwise the zstd/lz4/xz command line tools
+    if archiveFormat == "zst" and zstandard is not None:
+        writer = zstandard.ZstdCompressor(level=level, threads=threads).stream_writer(fileobj, closefd=False)
+        return writer, writer.close
+    if archiveFormat == "lz4" and lz4frame is not None:
+        writer = lz4frame.open(fileobj, "wb", compression_level=level)
+        return writer, writer.close
+    binary = shutil.which(compressBinaries[archiveFormat])
+    if binary is None:
+        if archiveFormat == "xz":
+            # single threaded, but always available
+            writer = lzma.open(fileobj, "wb", preset=level)
+            return writer, writer.close
+        raise ImportError(f"{archiveFormat} archives need the python package {compressModules[archiveFormat]} or the {compressBinaries[archiveFormat]} binary")
+    args = [binary, f"-{level}", "-q", "-c"]
+    if archiveFormat in ("zst", "xz"):
+        args.insert(2, f"-T{threads}")
+    if archiveFormat == "zst" and level > 19:
+        args.insert(1, "--ultra")
+    fileobj.flush()
+    proc = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=fileobj)
+
+    def finish():
+        proc.stdin.close()
+        if proc.wait() != 0:
+            raise OSError(f"{binary} failed with exit code {proc.returncode}")
+    return proc.stdin, finish
+
+
+def tarDecompressor(archiveFormat: str, fileobj):
+    if archiveFormat == "zst" and zstandard is not None:
+        return zstandard.ZstdDecompressor().stream_reader(fileobj), None
+    if archiveFormat == "lz4" and lz4frame is not None:
+        return lz4frame.open(fileobj, "rb"), None
+    binary = shutil.which(compressBinaries[archiveFormat])
+    if binary is None:
+        if archiveFormat == "xz":
+            return lzma.open(fileobj, "rb"), None
+        raise ImportError(f"{archiveFormat} archives need the python package {compressModules[archiveFormat]} or the {compressBinaries[archiveFormat]} binary")
+    proc = subprocess.Popen([binary, "-d", "-q", "-c"], stdin=fileobj, stdout=subprocess.PIPE)
+    return proc.stdout, proc
+
+
+def writeArchive(archiveFile: str, root: str, relPaths: List[str], deleted: List[str] = None,
+                 archiveFormat: str = "zip", level: int = None, threads: int = 0, emptyDirs: List[str] = None):
+    # streams the archive straight into archiveFile (written as .part and renamed when complete).
+    # emptyDirs are stored as folder entries like make_archive did
+    if level is None:
+        level = defaultCompressLevels[archiveFormat]
+    threads = compressionThreads(threads)
+    members = [(Path(root).name if relPath == "." else relPath, entryPath(root, relPath)) for relPath in relPaths]
+    deltaInfo = json.dumps({"deleted": deleted}).encode("utf-8") if deleted is not None else None
+    os.makedirs(Path(archiveFile).parent, exist_ok=True)
+    partFile = archiveFile + ".part"
+    with open(partFile, "wb") as f:
+        if archiveFormat == "zip":
+            writer = ParallelZipWriter(f, level, threads)
+            writer.addFiles(members)
+            for relPath in emptyDirs or []:
+                writer.addDir(relPath, os.stat(entryPath(root, relPath)))
+            if deltaInfo is not None:
+                writer.writeStr(deltaInfoName, deltaInfo)
+            writer.close()
+        else:
+            stream, finish = tarCompressor(archiveFormat, f, level, threads)
+            with tarfile.open(fileobj=stream, mode="w|") as tar:
+                for arcName, path in members:
+                    tar.add(path, arcName, recursive=False)
+                for relPath in emptyDirs or []:
+                    tar.add(entryPath(root, relPath), relPath, recursive=False)
+                if deltaInfo is not None:
+                    info = tarfile.TarInfo(deltaInfoName)
+                    info.size = len(deltaInfo)
+                    info.mtime = int(time.time())
+                    tar.addfile(info, io.BytesIO(deltaInfo))
+            finish()
+    os.replace(partFile, archiveFile)
+
+
+def archiveFormatOf(archive: Path) -> str:
+    for archiveFormat, extension in archiveExtensions.items():
+        if archive.name.endswith(extension):
+            return archiveFormat
+    return None
+
+
+def make_archive(destPath: str, src: str, archiveFormat: str = "zip", level: int = None, threads: int = 0):
+    now = datetime.now()
+    dt_string = now.strftime(archiveTimeFormat)
+    archiveFile = destPath+"/"+dt_string+archiveExtensions[archiveFormat]
+    if Path(src).is_dir():
+        emptyDirs = []
+        relPaths = sorted(scanTree(src, emptyDirs))
+        writeArchive(archiveFile, src, relPaths, archiveFormat=archiveFormat, level=level, threads=threads, emptyDirs=sorted(emptyDirs))
+    else:
+        writeArchive(archiveFile, src, ["."], archiveFormat=archiveFormat, level=level, threads=threads)
+    return archiveFile
 
 
 def deleteTmp(path: str):
@@ -75,10 +392,10 @@ def deleteTmp(path: str):
         print(f"{path} does not exist, seems to be the first backup-call")
 
 
-def createArchive(base: str, backupName: str):
+def createArchive(base: str, backupName: str, archiveFormat: str = "zip", level: int = None, threads: int = 0):
     tmpPath = base+tmpFolder+backupName
     backupPath = base+backupFolder+backupName
-    make_archive(backupPath, tmpPath)
+    return make_archive(backupPath, tmpPath, archiveFormat, level, threads)
 
 
 def compareEqual(filePath: str, tmpPath: str, shallow: bool):
@@ -111,13 +428,645 @@ def compareEqual(filePath: str, tmpPath: str, shallow: bool):
     return False
 
 
-def copyToTemp(filePath: str, tmpPath: str):
+@dataclass
+class ChangeSet:
+    added: List[str] = field(default_factory=list)
+    modified: List[str] = field(default_factory=list)
+    deleted: List[str] = field(default_factory=list)
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.modified or self.deleted)
+
+    def __str__(self) -> str:
+        return f"{len(self.added)} added, {len(self.modified)} modified, {len(self.deleted)} deleted"
+
+    def printReport(self):
+        for f in self.added:
+            print(f"  + {f}")
+        for f in self.modified:
+            print(f"  ~ {f}")
+        for f in self.deleted:
+            print(f"  - {f}")
+
+
+def entryPath(root: str, relPath: str) -> str:
+    # a backup of a single file is stored in the manifest as "."
+    if relPath == ".":
+        return str(root)
+    return os.path.join(root, relPath)
+
+
+def scanTree(path: str, emptyDirs: List[str] = None) -> Dict[str, os.stat_result]:
+    # one os.scandir pass over the tree, returns relative paths (always with "/") and their stat.
+    # Folders without any entry are added to emptyDirs if given, all other folders are implied by their files
+    if Path(path).is_file():
+        return {".": os.stat(path)}
+    result = {}
+    pending = [("", str(path))]
+    while pending:
+        relDir, curDir = pending.pop()
+        try:
+            entries = list(os.scandir(curDir))
+        except FileNotFoundError:
+            continue
+        if not entries and relDir and emptyDirs is not None:
+            emptyDirs.append(relDir[:-1])
+        for entry in entries:
+            relPath = relDir + entry.name
+            try:
+                if entry.is_dir():
+                    pending.append((relPath + "/", entry.path))
+                elif entry.is_file():
+                    result[relPath] = entry.stat()
+            except FileNotFoundError:
+                # deleted while scanning
+                continue
+    return result
+
+
+def hashFile(path: str) -> str:
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(hashBlockSize)
+            if not block:
+                break
+            h.update(block)
+            countBytes("hashedBytes", len(block))
+    return h.hexdigest()
+
+
+def statMatches(entry: dict, st: os.stat_result) -> bool:
+    # DirEntry.stat() of scanTree always reports inode 0 on windows while os.stat knows it, the inode only counts if
+    # both sides have one
+    inode = entry.get("inode")
+    return entry.get("size") == st.st_size and entry.get("mtime_ns") == st.st_mtime_ns and (inode == st.st_ino or not inode or not st.st_ino)
+
+
+def manifestEntry(st: os.stat_result, fileHash: str) -> dict:
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "inode": st.st_ino, "hash": fileHash}
+
+
+def loadManifest(manifestFile: str) -> Dict[str, dict]:
+    try:
+        with open(manifestFile, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("version") != manifestVersion:
+            return {}
+        return data["files"]
+    except (OSError, ValueError, KeyError):
+        return {}
+
+
+def saveManifest(manifestFile: str, files: Dict[str, dict]):
+    os.makedirs(Path(manifestFile).parent, exist_ok=True)
+    # write to a temporary file first, so an aborted run never leaves a broken manifest behind
+    tmpFile = manifestFile + ".tmp"
+    with open(tmpFile, "w", encoding="utf-8") as f:
+        json.dump({"version": manifestVersion, "files": files}, f)
+    os.replace(tmpFile, manifestFile)
+
+
+def buildManifest(path: str) -> Dict[str, dict]:
+    files = {}
+    for relPath, st in scanTree(path).items():
+        files[relPath] = manifestEntry(st, hashFile(entryPath(path, relPath)))
+    return files
+
+
+def detectChanges(filePath: str, previous: Dict[str, dict], shallow: bool):
+    # only files whose stat tuple changed get hashed, unless shallow is False, then every file is hashed
+    # returns the ChangeSet and the manifest describing the current state of filePath
+    changes = ChangeSet()
+    current = {}
+    for relPath, st in scanTree(filePath).items():
+        old = previous.get(relPath)
+        if old is not None and shallow and statMatches(old, st):
+            current[relPath] = old
+            continue
+        fileHash = hashFile(entryPath(filePath, relPath))
+        current[relPath] = manifestEntry(st, fileHash)
+        if old is not None and old.get("hash") == fileHash:
+            # same content, keep additional infos like the chunk list
+            current[relPath] = {**old, **current[relPath]}
+        if old is None:
+            changes.added.append(relPath)
+        elif old.get("hash") != fileHash:
+            changes.modified.append(relPath)
+    changes.deleted = [relPath for relPath in previous if relPath not in current]
+    changes.added.sort()
+    changes.modified.sort()
+    changes.deleted.sort()
+    return changes, current
+
+
+def copyToTemp(filePath: str, tmpPath: str, manifest: Dict[str, dict] = None, retries: int = None):
+    # with retries set the files of the manifest are captured one by one (see captureFiles)
     deleteTmp(tmpPath)
     os.makedirs(Path(tmpPath).parent, exist_ok=True)
+    emptyDirs = []
+    files = scanTree(filePath, emptyDirs)
+    relPaths = sorted(manifest) if manifest is not None else sorted(files)
+    if retries is not None and manifest is not None:
+        captureFiles(filePath, tmpPath, relPaths, manifest, retries)
+    else:
+        copyFiles([(entryPath(filePath, relPath), entryPath(tmpPath, relPath)) for relPath in relPaths])
+    # copytree kept empty folders too
+    for relPath in emptyDirs:
+        os.makedirs(entryPath(tmpPath, relPath), exist_ok=True)
+
+
+def makeDirs(files: List[str]):
+    # creates the parent folders of all files once, instead of one makedirs call per file
+    for folder in sorted({os.path.dirname(f) for f in files}):
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+
+def applyMetadata(src: str, dst: str, metadata: str):
+    # "none", "times" (enough for the archives and the manifest) or "all" (permissions, flags)
+    if metadata == "times":
+        st = os.stat(src)
+        os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns))
+    elif metadata == "all":
+        shutil.copystat(src, dst)
+
+
+def kernelCopy(src: str, dst: str) -> bool:
+    # copy_file_range lets the kernel (or the file server) copy the data without passing it through python
+    if not hasattr(os, "copy_file_range"):
+        return False
+    device = os.stat(src).st_dev
+    if device in copyFileRangeUnsupported:
+        return False
+    with open(src, "rb") as srcFile, open(dst, "wb") as dstFile:
+        try:
+            while os.copy_file_range(srcFile.fileno(), dstFile.fileno(), copyChunkSize):
+                pass
+        except OSError as e:
+            if e.errno in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EPERM):
+                copyFileRangeUnsupported.add(device)
+                return False
+            raise
+    return True
+
+
+def copyFile(src: str, dst: str, metadata: str = "times"):
+    # reflink clone, then copy_file_range, then shutil.copyfile (uses sendfile on linux and fcopyfile on mac)
+    if not reflinkFile(src, dst) and not kernelCopy(src, dst):
+        shutil.copyfile(src, dst)
+    applyMetadata(src, dst, metadata)
+
+
+def copyFiles(pairs: List[tuple], metadata: str = "times", threads: int = 0):
+    # pairs: list of (src, dst). Many small files are dominated by the per file overhead, so they are copied in parallel
+    makeDirs([dst for _, dst in pairs])
+    with ThreadPoolExecutor(max_workers=threads or copyThreads) as pool:
+        for future in [pool.submit(copyFile, src, dst, metadata) for src, dst in pairs]:
+            future.result()
+
+
+def sameStat(a: os.stat_result, b: os.stat_result) -> bool:
+    return a.st_size == b.st_size and a.st_mtime_ns == b.st_mtime_ns
+
+
+def reflinkFile(src: str, dst: str) -> bool:
+    # clones the file on filesystems that support it (btrfs, xfs, ...), this is nearly instant and shares the data blocks
+    if fcntl is None or not sys.platform.startswith("linux"):
+        return False
+    device = os.stat(Path(dst).parent).st_dev
+    if device in reflinkUnsupported:
+        return False
+    # errors of open (file deleted meanwhile, no permission) are raised like shutil.copyfile does
+    with open(src, "rb") as srcFile, open(dst, "wb") as dstFile:
+        try:
+            fcntl.ioctl(dstFile.fileno(), FICLONE, srcFile.fileno())
+        except OSError as e:
+            # only a filesystem without reflinks (or src on another one) disables them for the device, some
+            # answer ENOTTY instead of EOPNOTSUPP
+            if e.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL):
+                reflinkUnsupported.add(device)
+            return False
+    return True
+
+
+def captureFile(src: str, dst: str, retries: int) -> os.stat_result:
+    # copies src and checks that it did not change during the copy. Returns the stat of the copied version,
+    # None if the file was deleted meanwhile
+    for attempt in range(retries + 1):
+        try:
+            before = os.stat(src)
+            copyFile(src, dst)
+            after = os.stat(src)
+        except FileNotFoundError:
+            if os.path.isfile(dst):
+                os.remove(dst)
+            return None
+        if sameStat(before, after):
+            return after
+        if attempt < retries:
+            print(f"{src} changed while copying, retrying ({attempt + 1}/{retries})")
+            time.sleep(captureRetryDelay * (attempt + 1))
+    print(f"Warning: {src} kept changing while copying, the backup may contain a torn copy of it")
+    return after
+
+
+def captureFiles(filePath: str, tmpPath: str, relPaths: List[str], manifest: Dict[str, dict], retries: int) -> List[str]:
+    # only files that changed during their copy are copied again, the manifest is updated to the captured content.
+    # Returns the files that were deleted before they could be copied
+    vanished = []
+    targets = [entryPath(tmpPath, relPath) for relPath in relPaths]
+    makeDirs(targets)
+    with ThreadPoolExecutor(max_workers=copyThreads) as pool:
+        captured = list(pool.map(lambda relPath, target: captureFile(entryPath(filePath, relPath), target, retries), relPaths, targets))
+    for relPath, target, st in zip(relPaths, targets, captured):
+        if st is None:
+            vanished.append(relPath)
+            manifest.pop(relPath, None)
+        elif not statMatches(manifest[relPath], st):
+            # changed after the change detection hashed it
+            manifest[relPath] = manifestEntry(st, hashFile(target))
+    return vanished
+
+
+def removeEmptyParents(path: str, root: str):
+    parent = Path(path).parent
+    rootPath = Path(root)
+    while parent != rootPath and rootPath in parent.parents:
+        try:
+            parent.rmdir()
+        except OSError:
+            # not empty
+            break
+        parent = parent.parent
+
+
+def updateTemp(filePath: str, tmpPath: str, changes: ChangeSet, manifest: Dict[str, dict] = None, retries: int = None):
+    # only touch the changed paths instead of deleting and copying the whole temp copy again
     if Path(filePath).is_file():
-        shutil.copy(filePath, tmpPath)
+        copyToTemp(filePath, tmpPath, manifest, retries)
+        return
+    for relPath in changes.deleted:
+        target = entryPath(tmpPath, relPath)
+        if Path(target).is_file():
+            os.remove(target)
+            removeEmptyParents(target, tmpPath)
+    if retries is not None and manifest is not None:
+        for relPath in captureFiles(filePath, tmpPath, changes.added + changes.modified, manifest, retries):
+            if relPath in changes.modified:
+                changes.modified.remove(relPath)
+                changes.deleted.append(relPath)
+            else:
+                changes.added.remove(relPath)
     else:
-        shutil.copytree(filePath, tmpPath)
+        copyFiles([(entryPath(filePath, relPath), entryPath(tmpPath, relPath)) for relPath in changes.added + changes.modified])
+    # folders that are empty in the source, also those left empty by a deleted file
+    emptyDirs = []
+    scanTree(filePath, emptyDirs)
+    for relPath in emptyDirs:
+        os.makedirs(entryPath(tmpPath, relPath), exist_ok=True)
+
+
+def chunkPath(chunkRoot: str, chunkHash: str) -> str:
+    return os.path.join(chunkRoot, chunkHash[:2], chunkHash)
+
+
+def storeChunk(chunkRoot: str, data: bytes) -> str:
+    chunkHash = hashlib.blake2b(data, digest_size=20).hexdigest()
+    path = chunkPath(chunkRoot, chunkHash)
+    if os.path.exists(path):
+        # mark as used, so a garbage collection running in parallel keeps it
+        os.utime(path)
+        return chunkHash
+    packed = zlib.compress(data, 6)
+    # first byte: 1 = zlib compressed, 0 = stored (incompressible data like already packed savegames)
+    payload = b"\x01" + packed if len(packed) < len(data) else b"\x00" + data
+    os.makedirs(Path(path).parent, exist_ok=True)
+    partFile = f"{path}.{os.getpid()}.part"
+    with open(partFile, "wb") as f:
+        f.write(payload)
+    os.replace(partFile, path)
+    countBytes("chunkBytes", len(payload))
+    return chunkHash
+
+
+def touchChunks(chunkRoot: str, chunkHashes: list) -> bool:
+    # marks reused chunks as used like storeChunk does, False if one of them is gone
+    for chunkHash in chunkHashes:
+        try:
+            os.utime(chunkPath(chunkRoot, chunkHash))
+        except FileNotFoundError:
+            return False
+    return True
+
+
+def readChunk(chunkRoot: str, chunkHash: str) -> bytes:
+    with open(chunkPath(chunkRoot, chunkHash), "rb") as f:
+        payload = f.read()
+    if payload[:1] == b"\x01":
+        return zlib.decompress(payload[1:])
+    return payload[1:]
+
+
+def findChunkEnd(buffer: bytearray, eof: bool) -> int:
+    # returns the length of the next chunk in buffer, or 0 if more data is needed
+    if len(buffer) < chunkMaxSize and not eof:
+        return 0
+    if len(buffer) <= chunkMinSize:
+        return len(buffer)
+    limit = min(len(buffer), chunkMaxSize)
+    start = chunkMinSize - len(chunkCandidate)
+    # in pieces, most chunks end long before chunkMaxSize
+    while start + len(chunkCandidate) <= limit:
+        bits = buffer[start:start + chunkScanSize].translate(chunkBits)
+        candidate = bits.find(chunkCandidate)
+        while candidate != -1:
+            end = start + candidate + len(chunkCandidate)
+            if end > limit:
+                break
+            if zlib.crc32(buffer[end - chunkWindow:end]) & chunkCutMask == 0:
+                return end
+            candidate = bits.find(chunkCandidate, candidate + 1)
+        start += len(bits) - len(chunkCandidate) + 1
+    return limit
+
+
+def chunkFile(chunkRoot: str, path: str):
+    # returns the chunk list and the hash of the whole file
+    chunks = []
+    fileHash = hashlib.blake2b(digest_size=20)
+    buffer = bytearray()
+    eof = False
+    with open(path, "rb") as f:
+        while not eof or buffer:
+            if not eof:
+                block = f.read(chunkMaxSize)
+                if block:
+                    fileHash.update(block)
+                    buffer += block
+                else:
+                    eof = True
+            end = findChunkEnd(buffer, eof)
+            while end:
+                chunks.append(storeChunk(chunkRoot, bytes(buffer[:end])))
+                del buffer[:end]
+                end = findChunkEnd(buffer, eof) if buffer else 0
+    return chunks, fileHash.hexdigest()
+
+
+def captureChunks(chunkRoot: str, path: str, entry: dict, retries: int) -> bool:
+    # like captureFile, a file that changed while it was chunked is chunked again. Updates entry, False if the file is gone
+    for attempt in range(retries + 1):
+        try:
+            before = os.stat(path)
+            chunks, fileHash = chunkFile(chunkRoot, path)
+            after = os.stat(path)
+        except FileNotFoundError:
+            return False
+        entry.update(manifestEntry(after, fileHash))
+        entry["chunks"] = chunks
+        if sameStat(before, after):
+            return True
+        if attempt < retries:
+            print(f"{path} changed while reading, retrying ({attempt + 1}/{retries})")
+            time.sleep(captureRetryDelay * (attempt + 1))
+    print(f"Warning: {path} kept changing while reading, the backup may contain a torn copy of it")
+    return True
+
+
+def createCasVersion(base: str, filePath: str, backupPath: str, manifest: Dict[str, dict], retries: int = None):
+    # only files without a chunk list (new or changed content) are read, all others reuse the chunks of the last version
+    # as long as they still exist (a pruned version may have taken them with it)
+    chunkRoot = base+chunkFolder
+    files = {}
+    for relPath, entry in list(manifest.items()):
+        if "chunks" in entry and not touchChunks(chunkRoot, entry["chunks"]):
+            del entry["chunks"]
+        if "chunks" not in entry:
+            if retries is None:
+                entry["chunks"] = chunkFile(chunkRoot, entryPath(filePath, relPath))[0]
+            elif not captureChunks(chunkRoot, entryPath(filePath, relPath), entry, retries):
+                del manifest[relPath]
+                continue
+        files[relPath] = {"size": entry["size"], "mtime_ns": entry["mtime_ns"], "chunks": entry["chunks"]}
+    versionFile = os.path.join(backupPath, datetime.now().strftime(archiveTimeFormat) + casSuffix)
+    os.makedirs(backupPath, exist_ok=True)
+    with open(versionFile + ".part", "w", encoding="utf-8") as f:
+        json.dump({"version": manifestVersion, "root": Path(filePath).name, "files": files}, f)
+    os.replace(versionFile + ".part", versionFile)
+    return versionFile
+
+
+def restoreCasVersion(base: str, versionFile: Path, targetPath: str):
+    chunkRoot = base+chunkFolder
+    with open(versionFile, "r", encoding="utf-8") as f:
+        version = json.load(f)
+    files = [(safeJoin(targetPath, version["root"] if relPath == "." else relPath), entry) for relPath, entry in version["files"].items()]
+    makeDirs([target for target, _ in files])
+
+    def restoreFile(target: str, entry: dict):
+        with open(target, "wb") as out:
+            for chunkHash in entry["chunks"]:
+                out.write(readChunk(chunkRoot, chunkHash))
+        os.utime(target, ns=(entry["mtime_ns"], entry["mtime_ns"]))
+    with ThreadPoolExecutor(max_workers=copyThreads) as pool:
+        for future in [pool.submit(restoreFile, target, entry) for target, entry in files]:
+            future.result()
+
+
+def collectGarbage(base: str):
+    # removes every chunk that is not referenced by any version of any backup name
+    chunkRoot = base+chunkFolder
+    if not Path(chunkRoot).is_dir():
+        return
+    started = time.time()
+    referenced = set()
+    for versionFile in Path(base+backupFolder).rglob("*" + casSuffix):
+        try:
+            with open(versionFile, "r", encoding="utf-8") as f:
+                for entry in json.load(f)["files"].values():
+                    referenced.update(entry["chunks"])
+        except (OSError, ValueError, KeyError) as e:
+            # never delete chunks based on an unreadable version
+            print(f"Skipping garbage collection, could not read {versionFile}: {e}")
+            return
+    removed = 0
+    freed = 0
+    for prefix in os.scandir(chunkRoot):
+        if not prefix.is_dir():
+            continue
+        for chunk in os.scandir(prefix.path):
+            if chunk.name in referenced:
+                continue
+            st = chunk.stat()
+            if st.st_mtime > started - chunkGraceSeconds:
+                continue
+            try:
+                os.remove(chunk.path)
+            except FileNotFoundError:
+                # removed by a garbage collection running in parallel
+                continue
+            removed += 1
+            freed += st.st_size
+    if removed:
+        print(f"Garbage collection removed {removed} unreferenced chunks ({freed // (1024*1024)} MiB)")
+
+
+def archiveKind(archive: Path) -> str:
+    # "full", "delta", "cas" (version of the chunk store) or "legacy" (complete archives created by make_archive)
+    if archive.name.endswith(casSuffix):
+        return "cas"
+    stem = archive.name.split(".", 1)[0]
+    if stem.endswith(fullSuffix):
+        return "full"
+    if stem.endswith(deltaSuffix):
+        return "delta"
+    return "legacy"
+
+
+def archiveTime(archive: Path) -> datetime:
+    stem = archive.name.split(".", 1)[0]
+    for suffix in (fullSuffix, deltaSuffix):
+        if stem.endswith(suffix):
+            stem = stem[:-len(suffix)]
+    try:
+        return datetime.strptime(stem, archiveTimeFormat)
+    except ValueError:
+        return datetime.fromtimestamp(archive.stat().st_mtime)
+
+
+def archiveSortKey(archive: Path):
+    # a full archive written in the same second as a delta is always the older one
+    return (archiveTime(archive), 0 if archiveKind(archive) != "delta" else 1, archive.name)
+
+
+def listArchives(backupPath: str) -> List[Path]:
+    if not Path(backupPath).is_dir():
+        return []
+    return sorted((f for f in Path(backupPath).glob("*") if f.is_file() and isArchive(f)), key=archiveSortKey)
+
+
+def isArchive(f: Path) -> bool:
+    return archiveFormatOf(f) is not None or f.name.endswith(casSuffix)
+
+
+def splitChains(archives: List[Path]) -> List[List[Path]]:
+    # every full, cas or legacy archive starts a new chain, deltas depend on all archives before them in their chain
+    chains = []
+    for archive in archives:
+        if archiveKind(archive) == "delta" and chains:
+            chains[-1].append(archive)
+        else:
+            chains.append([archive])
+    return chains
+
+
+def createFullArchive(tmpPath: str, backupPath: str, manifest: Dict[str, dict], archiveFormat: str = "zip", level: int = None, threads: int = 0):
+    archiveFile = os.path.join(backupPath, datetime.now().strftime(archiveTimeFormat) + fullSuffix + archiveExtensions[archiveFormat])
+    emptyDirs = []
+    if Path(tmpPath).is_dir():
+        scanTree(tmpPath, emptyDirs)
+    writeArchive(archiveFile, tmpPath, sorted(manifest), archiveFormat=archiveFormat, level=level, threads=threads, emptyDirs=sorted(emptyDirs))
+    return archiveFile
+
+
+def createIncrementalArchive(tmpPath: str, backupPath: str, changes: ChangeSet, manifest: Dict[str, dict], fullEvery: int,
+                             archiveFormat: str = "zip", level: int = None, threads: int = 0):
+    # tmpPath already contains the new state. Writes a delta, or a new full archive every fullEvery deltas
+    chains = splitChains(listArchives(backupPath))
+    deltaCount = len(chains[-1]) - 1 if chains else 0
+    if not chains or archiveKind(chains[-1][0]) != "full" or (fullEvery and deltaCount >= fullEvery) or Path(tmpPath).is_file():
+        return createFullArchive(tmpPath, backupPath, manifest, archiveFormat, level, threads)
+    archiveFile = os.path.join(backupPath, datetime.now().strftime(archiveTimeFormat) + deltaSuffix + archiveExtensions[archiveFormat])
+    writeArchive(archiveFile, tmpPath, changes.added + changes.modified, changes.deleted, archiveFormat, level, threads)
+    return archiveFile
+
+
+def safeJoin(root: str, relPath: str) -> str:
+    target = os.path.normpath(os.path.join(root, relPath))
+    if os.path.commonpath([os.path.abspath(root), os.path.abspath(target)]) != os.path.abspath(root):
+        raise ValueError(f"{relPath} points outside of {root}")
+    return target
+
+
+def applyTar(archive: Path, targetPath: str):
+    deleted = []
+    with open(archive, "rb") as f:
+        stream, proc = tarDecompressor(archiveFormatOf(archive), f)
+        with tarfile.open(fileobj=stream, mode="r|") as tar:
+            for member in tar:
+                if member.name == deltaInfoName:
+                    deleted = json.loads(tar.extractfile(member).read())["deleted"]
+                elif member.isfile() or member.isdir():
+                    safeJoin(targetPath, member.name)
+                    tar.extract(member, targetPath, set_attrs=True)
+        if proc is not None and proc.wait() != 0:
+            raise OSError(f"decompressing {archive} failed")
+    for relPath in deleted:
+        target = safeJoin(targetPath, relPath)
+        if Path(target).is_file():
+            os.remove(target)
+            removeEmptyParents(target, targetPath)
+
+
+def applyArchive(base: str, archive: Path, targetPath: str):
+    if archiveKind(archive) == "cas":
+        restoreCasVersion(base, archive, targetPath)
+        return
+    if archiveFormatOf(archive) != "zip":
+        applyTar(archive, targetPath)
+        return
+    with zipfile.ZipFile(archive) as zf:
+        members = [m for m in zf.namelist() if m != deltaInfoName]
+        zf.extractall(targetPath, members)
+        if deltaInfoName in zf.namelist():
+            for relPath in json.loads(zf.read(deltaInfoName))["deleted"]:
+                target = safeJoin(targetPath, relPath)
+                if Path(target).is_file():
+                    os.remove(target)
+                    removeEmptyParents(target, targetPath)
+
+
+def restoreTemp(base: str, backupName: str, targetPath: str) -> bool:
+    # copies the TempFolder copy, the state of the last backup call, with the copy engine
+    tmpPath = base+tmpFolder+backupName
+    if not Path(tmpPath).exists():
+        print(f"No temp copy found for {backupName}")
+        return False
+    if Path(targetPath).exists() and any(Path(targetPath).iterdir()):
+        print(f"Restore target {targetPath} is not empty, please choose a new folder")
+        return False
+    emptyDirs = []
+    relPaths = sorted(scanTree(tmpPath, emptyDirs))
+    copyFiles([(entryPath(tmpPath, relPath), os.path.join(targetPath, Path(tmpPath).name if relPath == "." else relPath)) for relPath in relPaths],
+              metadata="all")
+    for relPath in emptyDirs:
+        os.makedirs(os.path.join(targetPath, relPath), exist_ok=True)
+    print(f"Restored {len(relPaths)} files from {tmpPath}")
+    return True
+
+
+def restore(base: str, backupName: str, targetPath: str, at: datetime = None) -> bool:
+    # rebuilds the state of the newest archive created at or before "at" (default: newest archive) into targetPath
+    backupPath = base+backupFolder+backupName
+    archives = listArchives(backupPath)
+    if at is not None:
+        archives = [a for a in archives if archiveTime(a) <= at]
+    if not archives:
+        print(f"No archive found for {backupName}" + (f" before {at}" if at else ""))
+        return False
+    if Path(targetPath).exists() and any(Path(targetPath).iterdir()):
+        print(f"Restore target {targetPath} is not empty, please choose a new folder")
+        return False
+    chain = splitChains(archives)[-1]
+    if archiveKind(chain[0]) == "delta":
+        print(f"Base archive for {chain[0].name} is missing, cannot restore")
+        return False
+    os.makedirs(targetPath, exist_ok=True)
+    for archive in chain:
+        print(f"Restoring {archive.name}")
+        applyArchive(base, archive, targetPath)
+    return True
 
 
 def IsNullOrDefault(val: int) -> bool:
@@ -128,22 +1077,296 @@ def IsNullOrDefault(val: int) -> bool:
     return False
 
 
-def checkVersionLimit(backupPath: str, versionsToKeep: int, daysToKeep: int):
-    scanPath = backupPath
-    if Path(scanPath).is_file():
-        scanPath = Path(scanPath).parent
-    if not IsNullOrDefault(daysToKeep) and not IsNullOrDefault(versionsToKeep):
-        print(
-            f"Both variants of versioning controll was used. appling both,daysToKeep:{daysToKeep}, versionsToKeep:{versionsToKeep}")
-    elif IsNullOrDefault(daysToKeep) and IsNullOrDefault(versionsToKeep):
-        print("No deletion dueto missing parameters. It is highly recommended to either include versionCount(-c) or deleteOlder(-o)")
+@dataclass
+class RetentionPolicy:
+    # versionsToKeep/daysToKeep behave like before: an archive is deleted if it is too old or not among the newest versions.
+    # The keep* buckets (grandfather-father-son) keep the newest archive of each of the last x hours/days/weeks/months,
+    # if one of them is set the newest versionsToKeep archives and all archives of the last daysToKeep days are kept as well.
+    # maxBytes: deletes the oldest archives until all archives of this backup are smaller (the newest one is always kept)
+    versionsToKeep: int = 0
+    daysToKeep: int = 0
+    keepHourly: int = 0
+    keepDaily: int = 0
+    keepWeekly: int = 0
+    keepMonthly: int = 0
+    maxBytes: int = 0
+
+    def buckets(self) -> List[tuple]:
+        return [(count, name, keyFormat) for count, name, keyFormat in
+                ((self.keepHourly, "hourly", "%Y-%m-%d %H"), (self.keepDaily, "daily", "%Y-%m-%d"),
+                 (self.keepWeekly, "weekly", "%G-W%V"), (self.keepMonthly, "monthly", "%Y-%m")) if count]
+
+    def __bool__(self) -> bool:
+        return bool(self.versionsToKeep or self.daysToKeep or self.buckets() or self.maxBytes)
 
-    files = sorted(Path(scanPath).glob('*'), key=os.path.getmtime)
 
-    if not IsNullOrDefault(daysToKeep):
-        checkFileDate(files, daysToKeep)
-    if not IsNullOrDefault(versionsToKeep):
-        checkFileCount(files, versionsToKeep)
+def catalogPath(backupPath: str) -> str:
+    # stored next to the backup folder, like the manifest next to the TempFolder copy
+    return str(backupPath).rstrip("/\\") + catalogSuffix
+
+
+def rebuildCatalog(backupPath: str) -> List[dict]:
+    entries = []
+    for archive in listArchives(backupPath):
+        entries.append({"name": archive.name, "time": archiveTime(archive).timestamp(), "size": archive.stat().st_size})
+    saveCatalog(backupPath, entries)
+    return entries
+
+
+def loadCatalog(backupPath: str) -> List[dict]:
+    # archives of this backup, oldest first. Only scans the backup folder if there is no catalog yet
+    try:
+        with open(catalogPath(backupPath), "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("version") == manifestVersion:
+            return data["archives"]
+    except (OSError, ValueError, KeyError):
+        pass
+    return rebuildCatalog(backupPath)
+
+
+def saveCatalog(backupPath: str, entries: List[dict]):
+    if not Path(backupPath).is_dir():
+        return
+    entries.sort(key=lambda e: (e["time"], 0 if archiveKind(Path(e["name"])) != "delta" else 1, e["name"]))
+    tmpFile = catalogPath(backupPath) + ".tmp"
+    with open(tmpFile, "w", encoding="utf-8") as f:
+        json.dump({"version": manifestVersion, "archives": entries}, f)
+    os.replace(tmpFile, catalogPath(backupPath))
+
+
+def registerArchives(backupPath: str, archives: List[str]):
+    if not Path(catalogPath(backupPath)).exists():
+        # first run with a catalog, the scan already contains the new archives
+        rebuildCatalog(backupPath)
+        return
+    entries = loadCatalog(backupPath)
+    known = {e["name"] for e in entries}
+    for archive in archives:
+        archive = Path(archive)
+        if archive.name not in known:
+            entries.append({"name": archive.name, "time": archiveTime(archive).timestamp(), "size": archive.stat().st_size})
+    saveCatalog(backupPath, entries)
+
+
+def selectExpired(entries: List[dict], policy: RetentionPolicy, now: float):
+    # returns the names of the archives to delete and the reasons why the others are kept
+    names = [e["name"] for e in entries]
+    reasons = {name: [] for name in names}
+    keep = set(names)
+    if policy.daysToKeep:
+        keep &= {e["name"] for e in entries if e["time"] >= now - int(policy.daysToKeep)*24*60*60}
+        for name in keep:
+            reasons[name].append(f"newer than {policy.daysToKeep} days")
+    if policy.versionsToKeep:
+        newest = set(names[-int(policy.versionsToKeep):])
+        keep &= newest
+        for name in newest:
+            reasons[name].append(f"newest {policy.versionsToKeep}")
+    buckets = policy.buckets()
+    if buckets:
+        if not policy.daysToKeep and not policy.versionsToKeep:
+            keep = set()
+        for count, bucketName, keyFormat in buckets:
+            seen = set()
+            for e in reversed(entries):
+                key = datetime.fromtimestamp(e["time"]).strftime(keyFormat)
+                if key in seen:
+                    continue
+                seen.add(key)
+                if len(seen) > count:
+                    break
+                keep.add(e["name"])
+                reasons[e["name"]].append(f"{bucketName} {key}")
+    if not policy.daysToKeep and not policy.versionsToKeep and not buckets:
+        keep = set(names)
+    chains = splitChains([Path(name) for name in names])
+    # incremental archives: a kept delta needs its full archive and all deltas before it
+    for chain in chains:
+        kept = [i for i, archive in enumerate(chain) if archive.name in keep]
+        for archive in chain[:kept[-1]+1] if kept else []:
+            if archive.name not in keep:
+                keep.add(archive.name)
+                reasons[archive.name].append("needed by a newer delta")
+    if policy.maxBytes:
+        sizes = {e["name"]: e["size"] for e in entries}
+        total = sum(sizes[name] for name in keep)
+        for chain in chains[:-1]:
+            if total <= policy.maxBytes:
+                break
+            for archive in chain:
+                if archive.name in keep:
+                    keep.discard(archive.name)
+                    total -= sizes[archive.name]
+        for name in keep:
+            if not reasons[name]:
+                reasons[name].append(f"within {policy.maxBytes // (1024*1024)} MiB")
+    return [name for name in names if name not in keep], reasons
+
+
+def printRetentionReport(entries: List[dict], expired: List[str], reasons: Dict[str, List[str]]):
+    expired = set(expired)
+    for e in entries:
+        state = "delete" if e["name"] in expired else "keep  "
+        why = "" if e["name"] in expired else ", ".join(reasons[e["name"]])
+        print(f"  {state} {e['name']:<40} {e['size'] // 1024:>10} KiB  {why}")
+    print(f"  {len(expired)} of {len(entries)} archives would be deleted, "
+          f"{sum(e['size'] for e in entries if e['name'] in expired) // (1024*1024)} MiB freed")
+
+
+def prune(backupPath: str, policy: RetentionPolicy, dryRun: bool = False) -> List[Path]:
+    # works on the catalog, the backup folder is not scanned. Only the deleted archives are touched
+    entries = loadCatalog(backupPath)
+    expired, reasons = selectExpired(entries, policy, time.time())
+    if dryRun:
+        printRetentionReport(entries, expired, reasons)
+        return []
+    removed = []
+    for name in expired:
+        archive = Path(backupPath) / name
+        try:
+            os.remove(archive)
+            removed.append(archive)
+        except FileNotFoundError:
+            # already deleted by hand, just forget it
+            pass
+    if expired:
+        expired = set(expired)
+        saveCatalog(backupPath, [e for e in entries if e["name"] not in expired])
+    return removed
+
+
+class BackupMetrics:
+    # durations, file counts and bytes of the phases of one backup() call, written as json line and/or prometheus textfile
+    def __init__(self, backupName: str, filePath: str):
+        self.backupName = backupName
+        self.filePath = filePath
+        self.started = time.time()
+        self.phases = {}
+        self.result = "failed"
+        # uncompressed bytes put into archives/chunks and the bytes that were written for them
+        self.archivedBytes = 0
+        self.archiveBytes = 0
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        stats = self.phases.setdefault(name, {"seconds": 0.0, "files": 0, "bytes": 0})
+        started = time.perf_counter()
+        try:
+            yield stats
+        finally:
+            stats["seconds"] += time.perf_counter() - started
+
+    def addArchive(self, archiveFile: str, uncompressedBytes: int):
+        self.archivedBytes += uncompressedBytes
+        self.archiveBytes += os.path.getsize(archiveFile)
+
+    def compressionRatio(self) -> float:
+        if not self.archiveBytes:
+            return None
+        return self.archivedBytes / self.archiveBytes
+
+    def record(self) -> dict:
+        return {"time": datetime.fromtimestamp(self.started).isoformat(timespec="seconds"), "backupName": self.backupName,
+                "filePath": str(self.filePath), "result": self.result, "seconds": time.time() - self.started, "phases": self.phases,
+                "archivedBytes": self.archivedBytes, "archiveBytes": self.archiveBytes, "compressionRatio": self.compressionRatio()}
+
+    def write(self, metricsLog: str = None, prometheusFile: str = None):
+        record = self.record()
+        with metricsLock:
+            if metricsLog:
+                os.makedirs(Path(metricsLog).absolute().parent, exist_ok=True)
+                with open(metricsLog, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record) + "\n")
+            if prometheusFile:
+                writePrometheus(prometheusFile, self.backupName, self.prometheusSamples(record))
+
+    def prometheusSamples(self, record: dict) -> List[tuple]:
+        # (metric, extra labels, value)
+        samples = [("backup_last_run_timestamp_seconds", "", self.started),
+                   ("backup_last_success", "", 0 if self.result == "failed" else 1),
+                   ("backup_last_changed", "", 1 if self.result == "archived" else 0),
+                   ("backup_duration_seconds", "", record["seconds"]),
+                   ("backup_archived_bytes", "", self.archivedBytes),
+                   ("backup_archive_bytes", "", self.archiveBytes)]
+        if self.compressionRatio() is not None:
+            samples.append(("backup_compression_ratio", "", self.compressionRatio()))
+        for name, stats in self.phases.items():
+            labels = f',phase="{name}"'
+            samples += [("backup_phase_duration_seconds", labels, stats["seconds"]),
+                        ("backup_phase_files", labels, stats["files"]),
+                        ("backup_phase_bytes", labels, stats["bytes"])]
+        return samples
+
+
+def writePrometheus(prometheusFile: str, backupName: str, samples: List[tuple]):
+    # textfile collector format. The file holds all backups, only the lines of this backup are replaced. Backups of other
+    # processes writing the same file take turns via a lock file (threads of this one via metricsLock), otherwise one
+    # would overwrite the lines the other just wrote
+    nameLabel = 'name="' + backupName.replace("\\", "\\\\").replace('"', '\\"') + '"'
+    os.makedirs(Path(prometheusFile).absolute().parent, exist_ok=True)
+    with open(prometheusFile + ".lock", "a") as lock:
+        lockFile(lock)
+        lines = []
+        try:
+            with open(prometheusFile, "r", encoding="utf-8") as f:
+                lines = [line.rstrip("\n") for line in f if line.strip() and not line.startswith("#")]
+        except OSError:
+            pass
+        lines = [line for line in lines if "{" + nameLabel + "," not in line and "{" + nameLabel + "}" not in line]
+        lines += [f"{metric}{{{nameLabel}{labels}}} {value:.15g}" for metric, labels, value in samples]
+        grouped = {}
+        for line in lines:
+            grouped.setdefault(line.split("{", 1)[0].split(" ", 1)[0], []).append(line)
+        output = []
+        for metric in sorted(grouped):
+            output.append(f"# HELP {metric} {prometheusHelp.get(metric, metric)}")
+            output.append(f"# TYPE {metric} gauge")
+            output += sorted(grouped[metric])
+        tmpFile = f"{prometheusFile}.{os.getpid()}.tmp"
+        with open(tmpFile, "w", encoding="utf-8") as f:
+            f.write("\n".join(output) + "\n")
+        os.replace(tmpFile, prometheusFile)
+
+
+def lockFile(f):
+    # waits for an exclusive lock on the open file f, it is released when f is closed
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        return
+    try:
+        import msvcrt
+    except ImportError:
+        return
+    f.seek(0)
+    while True:
+        try:
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            return
+        except OSError:
+            # LK_LOCK gives up after 10 seconds
+            pass
+
+
+def countBytes(counter: str, value: int):
+    # per thread counters, used to measure the bytes hashed/stored inside the phases of the current backup
+    setattr(phaseCounters, counter, getattr(phaseCounters, counter, 0) + value)
+
+
+def readCounter(counter: str) -> int:
+    return getattr(phaseCounters, counter, 0)
+
+
+def checkVersionLimit(backupPath: str, versionsToKeep: int, daysToKeep: int, policy: RetentionPolicy = None, dryRun: bool = False):
+    if policy is None:
+        policy = RetentionPolicy(versionsToKeep=versionsToKeep or 0, daysToKeep=daysToKeep or 0)
+    if not IsNullOrDefault(policy.daysToKeep) and not IsNullOrDefault(policy.versionsToKeep) and not policy.buckets():
+        print(
+            f"Both variants of versioning controll was used. appling both,daysToKeep:{policy.daysToKeep}, versionsToKeep:{policy.versionsToKeep}")
+    elif not policy:
+        print("No deletion dueto missing parameters. It is highly recommended to either include versionCount(-c) or deleteOlder(-o)")
+        return []
+    return prune(backupPath, policy, dryRun)
 
 # base: Root where the Backup structure is placed
 # filePath: file or folder you want to backup
@@ -151,36 +1374,169 @@ def checkVersionLimit(backupPath: str, versionsToKeep: int, daysToKeep: int):
 #   most time it should be the last part of the backup filePath. do not end it with slashes
 #   example:    -f C:/Users/Games/.chatty/settings backupName=.chatty/settings
 # versionsToKeep: deletes the oldest files if there are over x archives
-# shallowCheck: type of comparison to use. True checks only metadata if the file was changed. false should use bytewise comparison, check #https://docs.python.org/3/library/filecmp.html
+# shallowCheck: type of comparison to use. True only hashes files whose size/mtime/inode changed since the last backup (see the manifest next to BackupTemp/backupName). False hashes every file on each call
 # daysToKeep: deletes files after x days
+# keepHourly/keepDaily/keepWeekly/keepMonthly: keeps the newest archive of each of the last x hours/days/weeks/months
+# maxBytes: deletes the oldest archives until all archives of this backup together are smaller
+# incremental: instead of zipping the whole previous state, write a full archive once and afterwards only
+#   deltas with the changed and deleted files of each change (restore rebuilds any point in time from them)
+# fullEvery: incremental only, start a new full archive after x deltas (0: never)
+# storage: "zip" archives or "cas", a content addressed chunk store in base/Chunks shared by all backup names.
+#   With cas every version is a small json file in base/Backup/backupName, no TempFolder copy is kept and
+#   deleting versions removes chunks that are no longer used by any version
+# archiveFormat: zip (deflate on all cores, already compressed files are stored) or zst/lz4/xz (compressed tar)
+# compressLevel: compression level of the chosen format (default: 6 for zip and xz, 3 for zst, 0 for lz4)
+# compressThreads: number of threads used to compress (0: one per cpu)
+# consistent: for files that are written while the backup runs (running gameservers). Each file is re-checked after
+#   copying and copied again (only this file) if it changed meanwhile, at most captureRetries times. Uses reflinks if possible
 
 
-def backup(base: str, filePath: str, backupName: str, versionsToKeep: int = 0, shallowCheck: bool = True, daysToKeep: int = 0):
+def backup(base: str, filePath: str, backupName: str, versionsToKeep: int = 0, shallowCheck: bool = True, daysToKeep: int = 0,
+           incremental: bool = False, fullEvery: int = 10, storage: str = "zip",
+           archiveFormat: str = "zip", compressLevel: int = None, compressThreads: int = 0, consistent: bool = False,
+           keepHourly: int = 0, keepDaily: int = 0, keepWeekly: int = 0, keepMonthly: int = 0, maxBytes: int = 0,
+           metricsLog: str = None, prometheusFile: str = None):
     tmpPath = base+tmpFolder+backupName
     backupPath = base+backupFolder+backupName+"/"
+    manifestFile = tmpPath+manifestSuffix
+    retries = captureRetries if consistent else None
+    policy = RetentionPolicy(versionsToKeep or 0, daysToKeep or 0, keepHourly, keepDaily, keepWeekly, keepMonthly, maxBytes)
+    metrics = BackupMetrics(backupName, filePath)
     CheckDiskUsage(base)
 
-    if Path(tmpPath).exists():
-        # https://docs.python.org/3/library/filecmp.html
-        # for files: only save copies if there was a change
-        # TODO: for dirs there could be an iteration happen
-        if compareEqual(filePath, tmpPath, shallowCheck):
-            print(f"State: No changes found in {filePath}")
+    try:
+        if storage == "cas":
+            backupCas(base, filePath, backupPath, manifestFile, shallowCheck, policy, retries, metrics)
             return
+
+        created = []
+        if Path(tmpPath).exists():
+            with metrics.phase("compare") as stats:
+                hashedBefore = readCounter("hashedBytes")
+                previous = loadManifest(manifestFile)
+                if not previous:
+                    # temp copy from an older version of this script, seed the manifest from it once
+                    previous = buildManifest(tmpPath)
+                changes, manifest = detectChanges(filePath, previous, shallowCheck)
+                stats["files"] += len(manifest)
+                stats["bytes"] += readCounter("hashedBytes") - hashedBefore
+            if not changes:
+                print(f"State: No changes found in {filePath}")
+                metrics.result = "unchanged"
+                if manifest != previous:
+                    # content is equal but the stats changed, remember them to avoid hashing again
+                    saveManifest(manifestFile, manifest)
+                return
+            print(f"State: Found changes in {filePath} ({changes}), creating archive")
+            changes.printReport()
+            if incremental:
+                if not listArchives(backupPath):
+                    # keep the previous state as base of the chain
+                    with metrics.phase("archive") as stats:
+                        created.append(createFullArchive(tmpPath, backupPath, previous, archiveFormat, compressLevel, compressThreads))
+                        recordArchive(metrics, stats, created[-1], previous.values())
+                with metrics.phase("copy") as stats:
+                    updateTemp(filePath, tmpPath, changes, manifest, retries)
+                    recordCopy(stats, manifest, changes.added + changes.modified)
+                with metrics.phase("archive") as stats:
+                    created.append(createIncrementalArchive(tmpPath, backupPath, changes, manifest, fullEvery, archiveFormat, compressLevel, compressThreads))
+                    members = manifest.values() if archiveKind(Path(created[-1])) == "full" else [manifest[f] for f in changes.added + changes.modified]
+                    recordArchive(metrics, stats, created[-1], members)
+            else:
+                with metrics.phase("archive") as stats:
+                    created.append(createArchive(base, backupName, archiveFormat, compressLevel, compressThreads))
+                    recordArchive(metrics, stats, created[-1], previous.values())
+                with metrics.phase("copy") as stats:
+                    updateTemp(filePath, tmpPath, changes, manifest, retries)
+                    recordCopy(stats, manifest, changes.added + changes.modified)
         else:
-            print(f"State: Found changes in {filePath}, creating archive")
-            createArchive(base, backupName)
-        # delete tmp files to recreate without issue
+            with metrics.phase("compare") as stats:
+                manifest = buildManifest(filePath)
+                stats["files"] += len(manifest)
+                stats["bytes"] += sum(e["size"] for e in manifest.values())
+            with metrics.phase("copy") as stats:
+                copyToTemp(filePath, tmpPath, manifest, retries)
+                recordCopy(stats, manifest, list(manifest))
+            if incremental:
+                with metrics.phase("archive") as stats:
+                    created.append(createFullArchive(tmpPath, backupPath, manifest, archiveFormat, compressLevel, compressThreads))
+                    recordArchive(metrics, stats, created[-1], manifest.values())
+
+        saveManifest(manifestFile, manifest)
+        with metrics.phase("prune") as stats:
+            registerArchives(backupPath, created)
+            stats["files"] += len(checkVersionLimit(backupPath, versionsToKeep, daysToKeep, policy))
+        metrics.result = "archived" if created else "copied"
+    finally:
+        if metricsLog or prometheusFile:
+            metrics.write(metricsLog, prometheusFile)
+
+
+def recordCopy(stats: dict, manifest: Dict[str, dict], relPaths: List[str]):
+    stats["files"] += len(relPaths)
+    stats["bytes"] += sum(manifest[f]["size"] for f in relPaths if f in manifest)
 
-    copyToTemp(filePath, tmpPath)
-    checkVersionLimit(backupPath, versionsToKeep, daysToKeep)
+
+def recordArchive(metrics: BackupMetrics, stats: dict, archiveFile: str, members):
+    members = list(members)
+    uncompressed = sum(e["size"] for e in members)
+    stats["files"] += len(members)
+    stats["bytes"] += uncompressed
+    metrics.addArchive(archiveFile, uncompressed)
+
+
+def backupCas(base: str, filePath: str, backupPath: str, manifestFile: str, shallowCheck: bool, policy: RetentionPolicy,
+              retries: int = None, metrics: BackupMetrics = None):
+    if metrics is None:
+        metrics = BackupMetrics(backupPath, filePath)
+    with metrics.phase("compare") as stats:
+        hashedBefore = readCounter("hashedBytes")
+        previous = loadManifest(manifestFile)
+        changes, manifest = detectChanges(filePath, previous, shallowCheck)
+        stats["files"] += len(manifest)
+        stats["bytes"] += readCounter("hashedBytes") - hashedBefore
+    if previous and not changes and listArchives(backupPath):
+        print(f"State: No changes found in {filePath}")
+        metrics.result = "unchanged"
+        if manifest != previous:
+            saveManifest(manifestFile, manifest)
+        return
+    print(f"State: Found changes in {filePath} ({changes}), storing new version")
+    if previous:
+        changes.printReport()
+    with metrics.phase("archive") as stats:
+        # chunk store: the ratio compares the bytes of changed files with the bytes of the new chunks (dedup and compression)
+        chunked = [e for e in manifest.values() if "chunks" not in e]
+        chunkBytesBefore = readCounter("chunkBytes")
+        versionFile = createCasVersion(base, filePath, backupPath, manifest, retries)
+        stats["files"] += len(chunked)
+        stats["bytes"] += sum(e["size"] for e in chunked)
+        metrics.archivedBytes += sum(e["size"] for e in chunked)
+        metrics.archiveBytes += readCounter("chunkBytes") - chunkBytesBefore + os.path.getsize(versionFile)
+    saveManifest(manifestFile, manifest)
+    with metrics.phase("prune") as stats:
+        registerArchives(backupPath, [versionFile])
+        removed = checkVersionLimit(backupPath, policy.versionsToKeep, policy.daysToKeep, policy)
+        stats["files"] += len(removed)
+        if removed:
+            collectGarbage(base)
+    metrics.result = "archived"
+
+
+def parseSize(value: str) -> int:
+    # 1024 based, "20G" -> 20*1024^3
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+    value = value.strip().upper().rstrip("B")
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
 
 
 def main() -> int:
     parser = argparse.ArgumentParser(usage="Prepare both paths at the top of the script (use forward slashes to be sure), then use it like: \nbackupFiles.py -p x -n y [-c=i] [-o=j] or \npython backupFiles.py -p x -n y [-c=i] [-o=j] \nIt's highly recommended to use either -c or -o.",
                                      description=f"The Script copys the data to the TempFolder(base/{tmpFolder}/name) on the first call. On consecutive calls, if the data has changed, it creates archives of this file(in base/{backupFolder}/name) then exchanges the copy in TempFolder")
     parser.add_argument(
-        "--filePath", '-p', help="file or folder that you want to backup", required=True)
+        "--filePath", '-p', help="file or folder that you want to backup", required=False)
     parser.add_argument(
         "--base", '-b', help="BasePath Of the Backups. base/Backup and base/BackupTemp will be created", required=True)
     parser.add_argument(
@@ -191,10 +1547,56 @@ def main() -> int:
                         help="keep everything newer than o days", required=False, type=int)
     parser.add_argument("--shallowCompareType", '-s',
                         help="How should files be checked. If set to False, it should do byte-wise compares", required=False, default=True)
+    parser.add_argument("--incremental", '-i', action="store_true",
+                        help="write a full archive once and afterwards only delta archives with the changed and deleted files")
+    parser.add_argument("--fullEvery", '-f', type=int, default=10,
+                        help="incremental only: start a new full archive after x deltas (0: never)")
+    parser.add_argument("--storage", '-t', choices=["zip", "cas"], default="zip",
+                        help="zip archives or cas: deduplicated chunk store shared by all backups in base/Chunks")
+    parser.add_argument("--format", '-z', choices=list(archiveExtensions), default="zip",
+                        help="zip or a tar compressed with zst/lz4/xz (zst/lz4 need the python packages zstandard/lz4 or the zstd/lz4 binaries)")
+    parser.add_argument("--level", '-l', type=int, help="compression level of the chosen format")
+    parser.add_argument("--threads", '-j', type=int, default=0, help="number of threads used to compress (default: one per cpu)")
+    parser.add_argument("--consistent", '-k', action="store_true",
+                        help=f"copy files again (up to {captureRetries} times) that changed while being copied, for data of running servers")
+    parser.add_argument("--keepHourly", type=int, default=0, help="keep the newest archive of each of the last x hours")
+    parser.add_argument("--keepDaily", type=int, default=0, help="keep the newest archive of each of the last x days")
+    parser.add_argument("--keepWeekly", type=int, default=0, help="keep the newest archive of each of the last x weeks")
+    parser.add_argument("--keepMonthly", type=int, default=0, help="keep the newest archive of each of the last x months")
+    parser.add_argument("--maxSize", type=parseSize, default=0, help="maximum size of all archives of this backup, like 500M or 20G")
+    parser.add_argument("--metricsLog", help="append the durations, bytes and files of each phase as json line to this file")
+    parser.add_argument("--prometheusFile", help="write the metrics to this file for the node_exporter textfile collector (*.prom)")
+    parser.add_argument("--prune", action="store_true", help="only delete old archives by the given limits, do not create a backup")
+    parser.add_argument("--dryRun", action="store_true", help="prune only: print which archives would be deleted and why the others are kept")
+    parser.add_argument("--restore", '-r',
+                        help="restore the backup into this (new or empty) folder instead of creating a backup")
+    parser.add_argument("--at", '-a',
+                        help=f"restore only: point in time to restore, format {archiveTimeFormat.replace('%', '')} (default: newest archive). "
+                        "'latest' restores the TempFolder copy, the state of the last backup call")
     args = parser.parse_args()
 
-    backup(filePath=args.filePath, backupName=args.name, shallowCheck=args.shallowCompareType,
-           versionsToKeep=args.versionCount, daysToKeep=args.deleteOlderThan)
+    if args.restore and args.at == "latest":
+        return 0 if restoreTemp(args.base, args.name, args.restore) else 1
+    if args.restore:
+        at = datetime.strptime(args.at, archiveTimeFormat) if args.at else None
+        return 0 if restore(args.base, args.name, args.restore, at) else 1
+    policy = RetentionPolicy(args.versionCount or 0, args.deleteOlderThan or 0, args.keepHourly, args.keepDaily, args.keepWeekly,
+                             args.keepMonthly, args.maxSize)
+    if args.prune:
+        backupPath = args.base+backupFolder+args.name+"/"
+        removed = checkVersionLimit(backupPath, policy.versionsToKeep, policy.daysToKeep, policy, args.dryRun)
+        if any(f.name.endswith(casSuffix) for f in removed):
+            collectGarbage(args.base)
+        print(f"Deleted {len(removed)} archives")
+        return 0
+    if not args.filePath:
+        parser.error("--filePath is required to create a backup")
+
+    backup(base=args.base, filePath=args.filePath, backupName=args.name, shallowCheck=args.shallowCompareType,
+           versionsToKeep=args.versionCount, daysToKeep=args.deleteOlderThan, incremental=args.incremental, fullEvery=args.fullEvery,
+           storage=args.storage, archiveFormat=args.format, compressLevel=args.level, compressThreads=args.threads,
+           consistent=args.consistent, keepHourly=args.keepHourly, keepDaily=args.keepDaily, keepWeekly=args.keepWeekly,
+           keepMonthly=args.keepMonthly, maxBytes=args.maxSize, metricsLog=args.metricsLog, prometheusFile=args.prometheusFile)
 
 
 if __name__ == '__main__':
@@ -1,27 +1,133 @@
+import argparse
+import json
+import os
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 try:
-    import backupFiles
+	import backupFiles
 except ImportError:
-    raise ImportError('BackupFiles needs to be in the same folder or in an importable path!')
+	raise ImportError('BackupFiles needs to be in the same folder or in an importable path!')
 
 basePath = "E:/"
+# number of backups running at the same time
+maxWorkers = 4
+# number of backups writing to the same destination disk at the same time
+perDeviceLimit = 2
 
 #this file needs to be in the same folder as backupFiles.py
 
+#just exchange the folders or files to be backuped and choose a variant to delete.  if you want a maximum number of files exchange the daysToKeep with versionsToKeep
+#versionsToKeep = number of versions to keep
+#daysToKeep = deletes everything older than x days
+#instead of editing this list you can also pass a json or toml file with --config (see README.md)
+defaults = {"shallowCheck": True, "daysToKeep": 14}
+targets = [
+	{"filePath": "C:/Data/Servers/WinGSM/configs", "backupName": "WinGSM/configs"},
+	{"filePath": "C:/Data/Servers/WinGSM/plugins", "backupName": "WinGSM/plugins"},
+	{"filePath": "C:/Data/Servers/WinGSM/servers/1/configs", "backupName": "Enshrouded/configs"},
+	{"filePath": "C:/Data/Servers/WinGSM/servers/1/serverfiles/savegame", "backupName": "Enshrouded/serverfiles/savegame"},
+	{"filePath": "C:/Data/Servers/WinGSM/servers/2/configs", "backupName": "ProjectZomboid/configs"},
+	{"filePath": "C:/Data/Servers/WinGSM/servers/2/Zomboid", "backupName": "ProjectZomboid/Zomboid"},
+	{"filePath": "C:/Data/Servers/WinGSM/servers/3/configs", "backupName": "Smalland/configs"},
+	{"filePath": "C:/Data/Servers/WinGSM/servers/3/serverfiles/SMALLAND/Saved/SaveGames", "backupName": "Smalland/Smalland/Saved/SaveGames"},
+	{"filePath": "C:/Data/Servers/WinGSM/servers/3/serverfiles/SMALLAND/Saved/Config/WindowsServer", "backupName": "Smalland/Smalland/Saved/Config/WindowsServer"},
+]
+
+
+class JobResult:
+	def __init__(self, target: dict):
+		self.target = target
+		self.success = False
+		self.error = None
+		# seconds spent waiting for other backups on the same disk and seconds of the backup itself
+		self.waited = 0.0
+		self.duration = 0.0
+
+
+def loadConfig(configFile: str) -> dict:
+	if configFile.endswith(".toml"):
+		try:
+			import tomllib
+		except ImportError:
+			raise ImportError('toml configs need python 3.11+, please use a json config instead')
+		with open(configFile, "rb") as f:
+			return tomllib.load(f)
+	with open(configFile, "r", encoding="utf-8") as f:
+		return json.load(f)
+
+
+def deviceOf(path: str):
+	# the destination folder may not exist yet, use the nearest existing parent
+	cur = Path(path).absolute()
+	while not cur.exists() and cur != cur.parent:
+		cur = cur.parent
+	try:
+		return os.stat(cur).st_dev
+	except OSError:
+		return None
+
+
+def runJob(base: str, target: dict, deviceLocks: dict) -> JobResult:
+	result = JobResult(target)
+	options = {k: v for k, v in target.items() if k not in ("filePath", "backupName", "base")}
+	jobBase = target.get("base", base)
+	queued = time.perf_counter()
+	with deviceLocks[deviceOf(jobBase)]:
+		started = time.perf_counter()
+		result.waited = started - queued
+		try:
+			backupFiles.backup(jobBase, filePath=target["filePath"], backupName=target["backupName"], **options)
+			result.success = True
+		except Exception as e:
+			result.error = e
+			print(f"Backup of {target['filePath']} failed: {e}")
+		result.duration = time.perf_counter() - started
+	return result
+
+
+def runAll(base: str, jobs: list, workers: int, deviceLimit: int) -> list:
+	# every target has its own folders, so the archives are the same as in a serial run
+	deviceLocks = {}
+	for target in jobs:
+		device = deviceOf(target.get("base", base))
+		if device not in deviceLocks:
+			deviceLocks[device] = threading.BoundedSemaphore(max(1, deviceLimit))
+	with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+		futures = [pool.submit(runJob, base, target, deviceLocks) for target in jobs]
+		return [f.result() for f in futures]
+
+
+def printReport(results: list, duration: float):
+	print("Backup summary:")
+	for r in results:
+		state = "ok" if r.success else f"FAILED ({r.error})"
+		waited = f" (waited {r.waited:.2f}s for the disk)" if r.waited >= 0.01 else ""
+		print(f"  {r.duration:8.2f}s  {r.target['backupName']}: {state}{waited}")
+	print(f"  {duration:8.2f}s  total, {sum(r.duration for r in results):.2f}s if run one after another")
+
+
 def main() -> int:
+	parser = argparse.ArgumentParser(description="Backups all configured targets via backupFiles.py")
+	parser.add_argument("--config", '-c', help="json or toml file with basePath, defaults and targets, overwrites the lists in this script")
+	parser.add_argument("--workers", '-w', type=int, help=f"number of backups running at the same time (default {maxWorkers})")
+	parser.add_argument("--perDevice", '-d', type=int, help=f"number of backups writing to the same disk at the same time (default {perDeviceLimit})")
+	args = parser.parse_args()
+
+	config = {"basePath": basePath, "workers": maxWorkers, "perDeviceLimit": perDeviceLimit, "defaults": defaults, "targets": targets}
+	if args.config:
+		config.update(loadConfig(args.config))
+	workers = args.workers or config["workers"]
+	deviceLimit = args.perDevice or config["perDeviceLimit"]
+	jobs = [{**config.get("defaults", {}), **target} for target in config["targets"]]
+
 	print("Start Gameserver Backup")
-    #just exchange the folders or files to be backuped and choose a variant to delete.  if you want a maximum number of files exchange the daysToKeep with versionsToKeep
-    #versionsToKeep = number of versions to keep
-    #daysToKeep = deletes everything older than x days
-	backupFiles.backup(basePath, filePath="C:/Data/Servers/WinGSM/configs", backupName="WinGSM/configs", shallowCheck=True, daysToKeep=14)
-	backupFiles.backup(basePath, filePath="C:/Data/Servers/WinGSM/plugins", backupName="WinGSM/plugins", shallowCheck=True, daysToKeep=14)
-	backupFiles.backup(basePath, filePath="C:/Data/Servers/WinGSM/servers/1/configs", backupName="Enshrouded/configs", shallowCheck=True, daysToKeep=14)
-	backupFiles.backup(basePath, filePath="C:/Data/Servers/WinGSM/servers/1/serverfiles/savegame", backupName="Enshrouded/serverfiles/savegame", shallowCheck=True, daysToKeep=14)
-	backupFiles.backup(basePath, filePath="C:/Data/Servers/WinGSM/servers/2/configs", backupName="ProjectZomboid/configs", shallowCheck=True, daysToKeep=14)
-	backupFiles.backup(basePath, filePath="C:/Data/Servers/WinGSM/servers/2/Zomboid", backupName="ProjectZomboid/Zomboid", shallowCheck=True, daysToKeep=14)
-	backupFiles.backup(basePath, filePath="C:/Data/Servers/WinGSM/servers/3/configs", backupName="Smalland/configs", shallowCheck=True, daysToKeep=14)
-	backupFiles.backup(basePath, filePath="C:/Data/Servers/WinGSM/servers/3/serverfiles/SMALLAND/Saved/SaveGames", backupName="Smalland/Smalland/Saved/SaveGames", shallowCheck=True, daysToKeep=14)
-	backupFiles.backup(basePath, filePath="C:/Data/Servers/WinGSM/servers/3/serverfiles/SMALLAND/Saved/Config/WindowsServer", backupName="Smalland/Smalland/Saved/Config/WindowsServer", shallowCheck=True, daysToKeep=14)
+	started = time.perf_counter()
+	results = runAll(config["basePath"], jobs, workers, deviceLimit)
+	printReport(results, time.perf_counter() - started)
+	return 0 if all(r.success for r in results) else 1
 
 if __name__ == '__main__':
-    sys.exit(main())
\ No newline at end of file
+	sys.exit(main())
@@ -1,3 +1,5 @@
+import argparse
+import asyncio
 import datetime
 import enum
 import logging
@@ -7,11 +9,11 @@ import sys
 import shutil
 import time
 import json
+import math
+import random
+import re
 import signal
 from pathlib import Path
-from threading import Thread
-
-import psutil
 
 
 # Python version between 3.8 and 3.11 needed with modules requests and streamlink
@@ -25,6 +27,59 @@ ffmpegBinary = "C:\\Program Files\\Streamlink\\ffmpeg\\ffmpeg.exe"
 DestinationPath = "g:/StreamRecorder"
 VideoLibraryPath = "G:/Streams"
 DefaultChannels = ["staiy"]
+# how the live status of all channels is checked, one request per poll for all channels:
+# "gql" (twitch gql api), "streamlink" (one streamlink --json per channel) or the url of a json status service (see README.md)
+StatusChecker = "gql"
+TwitchGqlUrl = "https://gql.twitch.tv/gql"
+TwitchClientId = "kimne78kx3ncx6brgo4mv6wki5h1ko"
+# channels are checked every PollInterval seconds, every MinPollInterval around the times they usually go live
+# and up to every MaxPollInterval if they were not live for days. PollJitter spreads the checks (0.2 = +-20%)
+PollInterval = 60
+MinPollInterval = 20
+MaxPollInterval = 900
+PollJitter = 0.2
+# seconds around a usual start time in which a channel counts as hot
+HotWindow = 30*60
+# upper limit of status requests of all channels together (a gql request covers 100 channels, streamlink one)
+RequestsPerMinute = 30
+# "file": streamlink writes the stream to recorded/, ffmpeg fixes it into the library afterwards
+# "pipe": streamlink output is muxed by ffmpeg directly into the library while recording (half the disk writes)
+# "segments": ffmpeg writes SegmentSeconds long pieces while recording, they are joined after the stream
+RecordingMode = "file"
+SegmentSeconds = 60
+# external programs: at most MaxChildProcesses run at the same time (recordings count too), a status probe is stopped after
+# ProbeTimeout seconds and a pipe/segments recording that got no data for StallTimeout seconds is stopped
+MaxChildProcesses = 64
+ProbeTimeout = 60
+StallTimeout = 120
+# seconds a program waits for a free slot (MaxChildProcesses) before the call fails
+SlotTimeout = 60
+# seconds to wait for recordings to close their files when stopped by SIGTERM/Ctrl+C
+ShutdownTimeout = 30
+PipeChunkSize = 256*1024
+# optional fast disk for new recordings, they are moved to VideoLibraryPath in the background (None = record to VideoLibraryPath)
+IngestLibraryPath = None
+# bytes per second for moving recordings from IngestLibraryPath to VideoLibraryPath, 0 = unlimited
+MigrationBandwidth = 50*1024*1024
+# before a recording starts, space for ExpectedStreamHours is reserved with the bitrate (MBit/s) of its quality.
+# The bitrates are replaced by measured ones after a few recordings. MinFreeSpace (bytes) is never used
+ExpectedStreamHours = 8
+QualityBitrates = {"1080p": 8, "936p": 6, "720p": 4.5, "480p": 2.5, "360p": 1.2, "160p": 0.4}
+MinFreeSpace = 5*1024*1024*1024
+# number of recordings fixed by ffmpeg at the same time, 0 = depending on cpu cores and disks
+PostProcessWorkers = 0
+# log files are rotated at LogFileSize bytes, LogFileCount old files are kept
+LogFileSize = 10*1024*1024
+LogFileCount = 5
+# optional file with the channels (one per line or comma separated), used if no channels are given on the command line.
+# Changes of the file (or SIGHUP on linux) add/remove channels without restarting running recordings
+ChannelsFile = None
+# local http server with /metrics (prometheus) and /status (json), MetricsPort = 0 disables it
+MetricsHost = "127.0.0.1"
+MetricsPort = 9731
+# a crashed channel is restarted after this many seconds, doubled on each crash in a row up to MaxRestartDelay
+RestartDelay = 5
+MaxRestartDelay = 600
 
 class TwitchResponseStatus(enum.Enum):
     ONLINE = 0
@@ -36,18 +91,20 @@ class TwitchResponseStatus(enum.Enum):
 defaultQuality = "720p"
 
 class TwitchRecorder:
-    def __init__(self, username = "", logger = logging.getLogger()):
+    def __init__(self, username = "", logger = logging.getLogger(), postProcessQueue = None, libraryIndex = None, storage = None):
         # global configuration
         self.disable_ffmpeg = False
-        self.refresh = 60
         self.root_path = DestinationPath
         self.postOfflineLog = True
         # user configuration
         self.username = username
-        self.apiReturn = {}
         self.logger = logger
+        self.postProcessQueue = postProcessQueue
+        self.libraryIndex = libraryIndex
+        self.storage = storage
+        self.streamlinkProcess = None
 
-    def run(self):
+    async def prepare(self):
         # path to recorded stream
         recorded_path = os.path.join(self.root_path, "recorded", self.username)
         # path to finished video, errors removed
@@ -59,233 +116,1665 @@ class TwitchRecorder:
         if os.path.isdir(processed_path) is False:
             os.makedirs(processed_path)
 
-        # make sure the interval to check user availability is not less than 60 seconds
-        if self.refresh < 30:
-            self.refresh = 30
-
-        # fix videos from previous recording session
-        try:
-            video_list = [f for f in os.listdir(recorded_path) if os.path.isfile(os.path.join(recorded_path, f))]
-            if len(video_list) > 0:
-                self.logger.info("processing previously recorded files")
-            for f in video_list:
-                recorded_filename = os.path.join(recorded_path, f)
-                processed_filename = os.path.join(processed_path, f)
-                self.process_recorded_file(recorded_filename, processed_filename)
-        except Exception as e:
-            self.logger.error(e)
-
-        self.logger.info("checking for %s every %s seconds, recording ",
-                     self.username, self.refresh)
-        self.loop_check(recorded_path, processed_path)
+    def leftoverFiles(self) -> list:
+        # videos from a previous recording session, fixed by the post processing queue
+        recorded_path = os.path.join(self.root_path, "recorded", self.username)
+        processed_path = os.path.join(self.root_path, "processed", self.username)
+        video_list = [f for f in os.listdir(recorded_path) if os.path.isfile(os.path.join(recorded_path, f))]
+        leftovers = [(os.path.join(recorded_path, f), os.path.join(processed_path, f)) for f in video_list]
+        # segmented sessions know their target
+        for sessionFile in Path(recorded_path).glob("*.segments/session.json"):
+            try:
+                with open(sessionFile, "r", encoding="utf-8") as f:
+                    target = json.load(f)["target"]
+            except (OSError, ValueError, KeyError):
+                target = os.path.join(VideoLibraryPath, self.username, sessionFile.parent.name[:-len(".segments")] + ".mp4")
+            leftovers.append((str(sessionFile.parent), target))
+        return leftovers
 
-    def process_recorded_file(self, recorded_filename, processed_filename):
+    async def process_recorded_file(self, recorded_filename, processed_filename):
         if self.disable_ffmpeg:
             self.logger.info("moving: %s", recorded_filename)
-            shutil.move(recorded_filename, processed_filename)
+            await runInThread(shutil.move, recorded_filename, processed_filename)
         else:
             self.logger.info("fixing %s", recorded_filename)
-            self.ffmpeg_copy_and_fix_errors(recorded_filename, processed_filename)
+            await self.ffmpeg_copy_and_fix_errors(recorded_filename, processed_filename)
 
-    def ffmpeg_copy_and_fix_errors(self, recorded_filename, processed_filename):
+    async def ffmpeg_copy_and_fix_errors(self, recorded_filename, processed_filename):
+        args = [ffmpegBinary, "-err_detect","ignore_err", "-n", "-i", recorded_filename, "-c", "copy", processed_filename]
+        self.logger.info(f"starting ffmpeg with args (could take a few minutes without output):{subprocess.list2cmdline(args)}")
+        # raises if ffmpeg could not be started (no free slot, the recorder is stopping), the file is not moved unfixed then
+        result = await executor.run("ffmpeg-fix", args, owner=self.username)
         try:
-            args = None
-            if os.name == 'nt':
-                args = [ffmpegBinary, "-err_detect","ignore_err", "-n", "-i", recorded_filename, "-c", "copy", processed_filename]
-                self.logger.info(f"Start ffmpeg with args:{' '.join(args)}")
-            else:
-                args = f"{ffmpegBinary} -err_detect ignore_err -n -i \"{recorded_filename}\" -c copy \"{processed_filename}\""
-                self.logger.info(f"starting ffmpeg with args (could take a few minutes without output):{args}")
-            logData = subprocess.Popen(args, stderr=subprocess.PIPE, shell=True).communicate()
             if os.path.exists(processed_filename):
-                self.logger.info("ended ffmpeg successfully")
+                self.logger.info(f"ended ffmpeg successfully after {result.seconds:.0f} seconds")
+                metrics.remuxed(self.username, result.seconds, os.path.getsize(processed_filename))
                 os.remove(recorded_filename)
             else: 
-                self.logger.error(f"Ended ffmpeg with error: {logData}")
+                self.logger.error(f"Ended ffmpeg with error {result.returncode}: {result.stderrText()}")
         except Exception as e:
             self.logger.error(f"Exception on ffmpeg call: {e}")
 
-    def check_user(self):
-        title = None
-        status = TwitchResponseStatus.ERROR
-        quality = defaultQuality
+    def getAvailableStreamQuality(self, qualities) -> str:
+        # qualities is None if the status checker does not know them (gql), let streamlink choose from a fallback list then
+        if not qualities:
+            return f"{defaultQuality},{defaultQuality}60,480p,best"
+        if defaultQuality in qualities: 
+            return defaultQuality
+        keys = {}
+        for key in qualities:
+            if not "p" in key: 
+                continue
+            if defaultQuality.split("p", 1)[0] == key.split("p", 1)[0]:
+                return key
+            try:
+                keys[int(key.split("p", 1)[0])] = key
+                #.split("p", 1)[0] finds even stuff like p60 for 60fps
+            except Exception:
+                pass
+
+        targetRes = int(defaultQuality.split("p", 1)[0])
+        for curRes in sorted(keys, reverse=True):
+            #get the highst resolution under target in case the streamer uses some weird resolutions
+            if(targetRes > curRes): 
+                return keys[curRes]
+
+        return "720p,480p,best"
+
+    def getPartString(self):
+        # answered by the library index, recordings still waiting for post processing are in there as well.
+        # Failed sessions (nothing was recorded) do not take a part number
+        part = ""
+        sessions = self.libraryIndex.sessions(self.username, datetime.datetime.now().strftime("%Y-%m-%d"))
+        recorded = [s for s in sessions.values() if s["state"] != "failed"]
+        if len(recorded) != 0:
+            part = f" part {len(recorded)+1}"
+        return part
+
+    async def record(self, status):
+        self.logger.info("%s online, stream recording in session", self.username)
+        recorded_path = os.path.join(self.root_path, "recorded", self.username)
+        quality = self.getAvailableStreamQuality(status.qualities)
+        admission = self.storage.admit(self.username, quality, status.qualities)
+        if admission is None:
+            self.logger.error("not enough free disk space for a recording, checking again later")
+            return
+        quality = admission.quality
+
+        filename = self.username + " - " + datetime.datetime.now() \
+            .strftime("%Y-%m-%d") + self.getPartString() +" - " + (status.title or "") + ".mp4"
+
+        # clean filename from unnecessary characters
+        filename = "".join(x for x in filename if x.isalnum() or x in [" ", "-", "_", "."])
+
+        recorded_filename = os.path.join(recorded_path, filename)
+        processed_filename = os.path.join(admission.libraryPath, self.username, filename)
+        self.libraryIndex.add(self.username, filename, "recording")
+
+        # start streamlink process
+        if not os.path.isfile(streamlinkBinary):
+            self.logger.critical("Streamlink not set")
+        started = time.monotonic()
+        received = 0
+        metrics.recordingStarted(self.username, quality, status.startedAt)
         try:
-            data = self.getStreamData()
-            if data and self.streamIsOnline(data):
-                status = TwitchResponseStatus.ONLINE
-                title = self.getTitleOfStream(data)
-                quality = self.getAvailableStreamQuality(data)
-            elif not data:
-                self.logger.error(f"no data gathered")
+            if RecordingMode == "pipe":
+                received = await self.recordPipe(quality, recorded_filename, processed_filename)
+            elif RecordingMode == "segments":
+                received = await self.recordSegments(quality, recorded_filename, processed_filename)
             else:
-                status = TwitchResponseStatus.OFFLINE
+                received = await self.recordFile(quality, recorded_filename, processed_filename)
+        finally:
+            metrics.recordingEnded(self.username)
+            self.storage.release(admission, received, time.monotonic() - started)
 
-        except Exception as e:
-            status = TwitchResponseStatus.OFFLINE
-        return status, title, quality
+    async def recordFile(self, quality, recorded_filename, processed_filename):
+        filename = os.path.basename(recorded_filename)
+        args = self.streamlinkArgs(quality, ["-o", recorded_filename])
+        self.logger.info(f"Start StreamLink with args:{subprocess.list2cmdline(args)}")
 
-    def getStreamData(self):
-        args = None
-        if os.name == 'nt':
-            args = [streamlinkBinary, "--json", f"twitch.tv/{self.username}"]
+        watcher = asyncio.ensure_future(self.watchFileSize(recorded_filename))
+        try:
+            result = await executor.run("streamlink-record", args, owner=self.username, keepStdout=False, onStart=self.setStreamlinkProcess)
+        finally:
+            watcher.cancel()
+        self.streamlinkProcess = None
+        
+        received = 0
+        if os.path.exists(recorded_filename):
+            received = os.path.getsize(recorded_filename)
+            self.logger.info("recording stream is done, queued for processing")
+            self.libraryIndex.update(self.username, filename, "queued")
+            self.postProcessQueue.submit(self.username, recorded_filename, processed_filename)
         else:
-            args = f"\"{streamlinkBinary}\" --json twitch.tv/{self.username}"
-        data = None
+            self.libraryIndex.update(self.username, filename, "failed")
+            self.logger.error(f"recording stream failed with {result.returncode}: {result.stdout.decode(errors='replace')} {result.stderrText()}")
+        self.logger.info("going back to checking...")
+        return received
+
+    async def watchFileSize(self, path):
+        # streamlink writes the file itself, the metrics follow its size
+        last = 0
+        while True:
+            await asyncio.sleep(1 if last == 0 else 10)
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                continue
+            if last == 0 and size > 0:
+                metrics.firstByte(self.username)
+            metrics.received(self.username, size - last)
+            last = size
+
+    def setStreamlinkProcess(self, proc):
+        self.streamlinkProcess = proc
+
+    def stopRecording(self):
+        # streamlink ends, ffmpeg sees the end of the pipe and closes its file (and the current segment) properly
+        if self.streamlinkProcess is not None and self.streamlinkProcess.returncode is None:
+            self.logger.info("stopping recording")
+            self.streamlinkProcess.terminate()
+
+    def terminateProcesses(self):
+        executor.terminate(self.username)
+
+    def streamlinkArgs(self, quality, output) -> list:
+        logFile = os.path.join(DestinationPath, f'{self.username}_{datetime.datetime.now().strftime("%Y-%m-%d")}_streamlink.log')
+        return [streamlinkBinary, "--twitch-disable-ads", "--twitch-low-latency", "--logfile", logFile,
+                f"twitch.tv/{self.username}", str(quality)] + output
+
+    async def recordPipe(self, quality, recorded_filename, processed_filename):
+        # ffmpeg muxes the stream straight into the library as fragmented mp4 (playable while it grows and after a crash),
+        # so the stream is written once instead of recorded, copied and deleted
+        if not os.path.exists(os.path.dirname(processed_filename)):
+            os.makedirs(os.path.dirname(processed_filename))
+        ffmpegArgs = [ffmpegBinary, "-hide_banner", "-loglevel", "error", "-err_detect", "ignore_err", "-i", "pipe:0",
+                      "-c", "copy", "-movflags", "+frag_keyframe+empty_moov+default_base_moof", "-f", "mp4", "-n", processed_filename]
+        received = await self.recordPiped(quality, ffmpegArgs, os.path.splitext(recorded_filename)[0] + ".ts",
+                                          os.path.splitext(processed_filename)[0] + " recovered.mp4")
+        if os.path.exists(processed_filename) and os.path.getsize(processed_filename) == 0:
+            os.remove(processed_filename)
+        self.finalized(os.path.basename(processed_filename), processed_filename)
+        self.logger.info("going back to checking...")
+        return received
+
+    async def recordSegments(self, quality, recorded_filename, processed_filename):
+        # ffmpeg cuts the stream into SegmentSeconds long .ts files in <name>.segments/ and lists every finished segment
+        # in index.csv. After the stream the post processing queue joins them without re-encoding. If the recorder dies,
+        # only the last segment is incomplete and the session is joined on the next start
+        sessionDir = os.path.splitext(recorded_filename)[0] + ".segments"
+        os.makedirs(sessionDir, exist_ok=True)
+        with open(os.path.join(sessionDir, "session.json"), "w", encoding="utf-8") as f:
+            json.dump({"channel": self.username, "target": processed_filename}, f)
+        ffmpegArgs = [ffmpegBinary, "-hide_banner", "-loglevel", "error", "-err_detect", "ignore_err", "-i", "pipe:0",
+                      "-c", "copy", "-f", "segment", "-segment_time", str(SegmentSeconds), "-segment_format", "mpegts",
+                      "-segment_list", os.path.join(sessionDir, "index.csv"), "-segment_list_type", "csv",
+                      os.path.join(sessionDir, "seg%05d.ts")]
         try:
-            output = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True).communicate()
-            data = json.loads(output[0])
-        except Exception as e:
-            self.logger.error(f"gathering infos via streamlink failed: {e}")
-        return data
-
-    def getTitleOfStream(self, data) -> str:
-        return data["metadata"]["title"]
-
-    def streamIsOnline(self, data) -> bool:
-        return len(data["streams"]) != 0
-
-    def getAvailableStreamQuality(self, data) -> str:
-        stream = None
-        quality = defaultQuality
-        streams = data["streams"]
-        if len(streams) < 1:
-            return 
-        if quality in streams: 
-            return quality
-        if streams:
-            keys = []
+            received = await self.recordPiped(quality, ffmpegArgs, os.path.splitext(recorded_filename)[0] + ".ts",
+                                              os.path.splitext(processed_filename)[0] + " recovered.mp4")
+        finally:
+            # also if the recording could not start or was cancelled on shutdown, the job joins what was written
+            # (or removes the empty folder)
+            self.libraryIndex.update(self.username, os.path.basename(processed_filename), "queued")
+            self.postProcessQueue.submit(self.username, sessionDir, processed_filename)
+        self.logger.info("going back to checking...")
+        return received
+
+    async def recordPiped(self, quality, ffmpegArgs, rawFilename, rawTarget):
+        # streamlink writes to stdout and the bytes are pumped into ffmpeg. If ffmpeg fails the rest of the stream
+        # is kept as raw .ts in recorded/ and fixed by the post processing queue
+        args = self.streamlinkArgs(quality, ["--stdout"])
+        self.logger.info(f"Start StreamLink with args:{subprocess.list2cmdline(args)}")
+        # slots for streamlink and ffmpeg together, a streamlink waiting for its ffmpeg would block a slot
+        await executor.reserve(2)
+        try:
+            streamlink = await executor.start("streamlink-record", args, owner=self.username, reserved=True, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        except BaseException:
+            executor.release()
+            raise
+        self.streamlinkProcess = streamlink
+        ffmpeg = None
+        raw = None
+        try:
+            self.logger.info(f"muxing with ffmpeg args:{subprocess.list2cmdline(ffmpegArgs)}")
+            ffmpeg = await executor.start("ffmpeg-mux", ffmpegArgs, owner=self.username, reserved=True, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            ffmpegLog = asyncio.ensure_future(readTail(ffmpeg.stderr))
+        except OSError as e:
+            self.logger.error(f"could not start ffmpeg, keeping the raw stream: {e}")
+            raw = open(rawFilename, "ab")
+        written = 0
+        try:
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(streamlink.stdout.read(PipeChunkSize), StallTimeout)
+                except asyncio.TimeoutError:
+                    self.logger.error(f"no data from streamlink for {StallTimeout} seconds, stopping it")
+                    await executor.stop(streamlink)
+                    break
+                if not chunk:
+                    break
+                if written == 0:
+                    metrics.firstByte(self.username)
+                written += len(chunk)
+                metrics.received(self.username, len(chunk))
+                if raw is None:
+                    try:
+                        if ffmpeg.returncode is not None:
+                            raise BrokenPipeError(f"ffmpeg exited with {ffmpeg.returncode}")
+                        ffmpeg.stdin.write(chunk)
+                        await ffmpeg.stdin.drain()
+                        continue
+                    except (BrokenPipeError, ConnectionResetError) as e:
+                        self.logger.error(f"ffmpeg failed while muxing, keeping the rest of the stream as {rawFilename}: {e}")
+                        raw = open(rawFilename, "ab")
+                raw.write(chunk)
+        finally:
+            if ffmpeg is not None:
+                try:
+                    ffmpeg.stdin.close()
+                except Exception:
+                    pass
+                await ffmpeg.wait()
+                logData = await ffmpegLog
+                if ffmpeg.returncode != 0:
+                    self.logger.error(f"ffmpeg ended with {ffmpeg.returncode}: {logData.decode(errors='replace')}")
+            if raw is not None:
+                raw.close()
+            await streamlink.wait()
+            self.streamlinkProcess = None
+
+        self.logger.info(f"recording stream is done, {written} bytes received")
+        if raw is not None and os.path.getsize(rawFilename) > 0:
+            self.postProcessQueue.submit(self.username, rawFilename, rawTarget, session=os.path.basename(rawTarget).replace(" recovered.mp4", ".mp4"))
+        elif raw is not None:
+            os.remove(rawFilename)
+        return written
+
+    def finalized(self, session, path):
+        # the file of a recording is complete
+        self.libraryIndex.finished(self.username, session, path)
+        if os.path.exists(path):
+            self.storage.migrateLater(self.username, session, path)
+
+    async def finish_recorded_file(self, recorded_filename, processed_filename):
+        # runs in the post processing queue
+        if not os.path.exists(os.path.dirname(processed_filename)):
+            os.makedirs(os.path.dirname(processed_filename))
+        if os.path.isdir(recorded_filename):
+            await self.concatSegments(recorded_filename, processed_filename)
+            return
+        if os.path.exists(recorded_filename) is True:
+            await self.process_recorded_file(recorded_filename, processed_filename)
+        else:
+            self.logger.info("skip fixing, file not found")
             
-            for key in list(streams.keys()):
-                if not "p" in key: 
-                    continue
-                if defaultQuality.split("p", 1)[0] == key.split("p", 1)[0]:
-                    return key
+        if os.path.exists(recorded_filename) and os.path.exists(processed_filename) is False : #ffmpg failed, copy without fix
+            await runInThread(shutil.move, recorded_filename, processed_filename)
+        self.logger.info("processing of %s is done", recorded_filename)
+
+
+    def segmentList(self, sessionDir) -> list:
+        # order of index.csv, segments missing there (the one being written when the recorder died) are added at the end
+        segments = []
+        try:
+            with open(os.path.join(sessionDir, "index.csv"), "r", encoding="utf-8") as f:
+                for line in f:
+                    name = line.split(",", 1)[0].strip()
+                    if name and name not in segments and os.path.exists(os.path.join(sessionDir, name)):
+                        segments.append(name)
+        except OSError:
+            pass
+        for f in sorted(Path(sessionDir).glob("seg*.ts")):
+            if f.name not in segments and f.stat().st_size > 0:
+                segments.append(f.name)
+        return segments
+
+    async def concatSegments(self, sessionDir, processed_filename):
+        segments = self.segmentList(sessionDir)
+        if not segments:
+            self.logger.info("no segments in %s", sessionDir)
+            await runInThread(shutil.rmtree, sessionDir, True)
+            return
+        listFile = os.path.join(sessionDir, "concat.txt")
+        with open(listFile, "w", encoding="utf-8") as f:
+            for name in segments:
+                f.write(f"file '{name}'\n")
+        if os.path.exists(processed_filename):
+            # half written output of an interrupted join
+            os.remove(processed_filename)
+        args = [ffmpegBinary, "-hide_banner", "-loglevel", "error", "-err_detect", "ignore_err", "-f", "concat", "-safe", "0",
+                "-i", listFile, "-c", "copy", "-n", processed_filename]
+        self.logger.info(f"joining {len(segments)} segments with args:{subprocess.list2cmdline(args)}")
+        result = await executor.run("ffmpeg-concat", args, owner=self.username)
+        if result.returncode != 0 or not os.path.exists(processed_filename):
+            raise RuntimeError(f"joining segments failed, keeping {sessionDir}: {result.stderrText()}")
+        self.logger.info("joined segments into %s", processed_filename)
+        metrics.remuxed(self.username, result.seconds, os.path.getsize(processed_filename))
+        await runInThread(shutil.rmtree, sessionDir, True)
+
+
+class LibraryIndex:
+    # recordings per channel and day, kept in a json file, so part numbers and --list do not have to scan the library
+    # (and spin up its disks). A channel missing in the index is read from its library folder once
+    # {"channel": {"2024-01-31": {"channel - 2024-01-31 - title.mp4": {"state": "done", "files": {"path": size}}}}}
+    datePattern = re.compile(r" - (\d{4}-\d{2}-\d{2})[ -]")
+
+    def __init__(self, indexFile):
+        self.indexFile = indexFile
+        try:
+            with open(indexFile, "r", encoding="utf-8") as f:
+                self.channels = json.load(f)
+        except (OSError, ValueError):
+            self.channels = {}
+
+    def save(self):
+        # the DestinationPath may not exist yet (--list or --rebuildIndex before the first start)
+        os.makedirs(os.path.dirname(self.indexFile), exist_ok=True)
+        tmp = self.indexFile + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.channels, f)
+        os.replace(tmp, self.indexFile)
+
+    def channel(self, channelName) -> dict:
+        if channelName not in self.channels:
+            self.rebuild(channelName)
+        return self.channels[channelName]
+
+    def rebuild(self, channelName):
+        days = {}
+        try:
+            entries = list(os.scandir(os.path.join(VideoLibraryPath, channelName)))
+        except OSError:
+            entries = []
+        for entry in entries:
+            date = self.dateOf(entry.name)
+            if date is None or not entry.is_file():
+                continue
+            session = entry.name.replace(" recovered.mp4", ".mp4")
+            record = days.setdefault(date, {}).setdefault(session, {"state": "done", "files": {}})
+            record["files"][entry.path] = entry.stat().st_size
+        self.channels[channelName] = days
+        self.save()
+
+    def dateOf(self, name):
+        match = self.datePattern.search(name)
+        return match.group(1) if match else None
+
+    def sessions(self, channelName, date) -> dict:
+        return self.channel(channelName).get(date, {})
+
+    def add(self, channelName, session, state):
+        date = self.dateOf(session) or datetime.datetime.now().strftime("%Y-%m-%d")
+        self.channel(channelName).setdefault(date, {})[session] = {"state": state, "files": {}}
+        self.save()
+
+    def update(self, channelName, session, state):
+        date = self.dateOf(session) or datetime.datetime.now().strftime("%Y-%m-%d")
+        self.channel(channelName).setdefault(date, {}).setdefault(session, {"state": state, "files": {}})["state"] = state
+        self.save()
+
+    def moved(self, channelName, session, oldPath, newPath):
+        date = self.dateOf(session) or datetime.datetime.now().strftime("%Y-%m-%d")
+        files = self.channel(channelName).setdefault(date, {}).setdefault(session, {"state": "done", "files": {}})["files"]
+        files[newPath] = files.pop(oldPath, 0) or os.path.getsize(newPath)
+        self.save()
+
+    def finished(self, channelName, session, path):
+        date = self.dateOf(session) or datetime.datetime.now().strftime("%Y-%m-%d")
+        record = self.channel(channelName).setdefault(date, {}).setdefault(session, {"state": "done", "files": {}})
+        try:
+            record["files"][path] = os.path.getsize(path)
+            record["state"] = "done"
+        except OSError:
+            record["state"] = "failed" if not record["files"] else "done"
+        self.save()
+
+
+class Admission:
+    def __init__(self, quality, libraryPath, needs, bytesPerSecond):
+        self.quality = quality
+        self.libraryPath = libraryPath
+        # bytes reserved per disk (st_dev)
+        self.needs = needs
+        self.bytesPerSecond = bytesPerSecond
+        self.started = time.monotonic()
+
+    def reserved(self, device) -> int:
+        # the reservation shrinks by what the recording should have written by now, that is already taken from the free space
+        return max(0, int(self.needs.get(device, 0) - (time.monotonic() - self.started) * self.bytesPerSecond))
+
+
+class StorageManager:
+    # decides where a recording is written and in which quality. Before it starts, space for ExpectedStreamHours at the
+    # estimated bitrate is reserved on every disk the recording writes to. If a disk is short on space the next library
+    # (IngestLibraryPath, then VideoLibraryPath) and then lower qualities are tried. Recordings finished on the ingest disk
+    # are moved to VideoLibraryPath in the background with at most MigrationBandwidth bytes per second
+    def __init__(self, bitrateFile, libraryIndex, logger):
+        self.bitrateFile = bitrateFile
+        self.libraryIndex = libraryIndex
+        self.logger = logger
+        self.admissions = set()
+        self.migrations = None
+        self.task = None
+        self.stopping = False
+        try:
+            with open(bitrateFile, "r", encoding="utf-8") as f:
+                self.measured = json.load(f)
+        except (OSError, ValueError):
+            self.measured = {}
+
+    def libraries(self) -> list:
+        return [IngestLibraryPath, VideoLibraryPath] if IngestLibraryPath else [VideoLibraryPath]
+
+    def resolution(self, quality):
+        # "720p60" -> 720, a selector like "720p,480p,best" counts with its first entry
+        try:
+            return int(str(quality).split(",")[0].split("p", 1)[0])
+        except ValueError:
+            return None
+
+    def bytesPerSecond(self, quality) -> float:
+        resolution = self.resolution(quality)
+        if resolution is None:
+            # best/source
+            resolution = 1080
+        key = f"{resolution}p"
+        if key in self.measured:
+            return self.measured[key]
+        known = sorted(QualityBitrates, key=lambda k: abs(int(k[:-1]) - resolution))
+        return QualityBitrates[known[0]] * 1000000 / 8
+
+    def observe(self, quality, received, seconds):
+        # moving average of what recordings of a quality really needed
+        resolution = self.resolution(quality)
+        if resolution is None or seconds < 300 or received <= 0:
+            return
+        key = f"{resolution}p"
+        rate = received / seconds
+        self.measured[key] = rate if key not in self.measured else self.measured[key] * 0.8 + rate * 0.2
+        tmp = self.bitrateFile + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.measured, f)
+        os.replace(tmp, self.bitrateFile)
+
+    def device(self, path):
+        try:
+            return os.stat(path).st_dev
+        except OSError:
+            return None
+
+    def free(self, path, device) -> int:
+        try:
+            free = shutil.disk_usage(path).free
+        except OSError:
+            return 0
+        return free - MinFreeSpace - sum(a.reserved(device) for a in self.admissions)
+
+    def candidates(self, quality, qualities) -> list:
+        # the chosen quality and then the lower ones, from the stream's list if known
+        result = [quality]
+        chosen = self.resolution(quality) or 100000
+        if qualities:
+            lower = sorted({q for q in qualities if (self.resolution(q) or 100000) < chosen}, key=lambda q: -self.resolution(q))
+            result += lower
+        else:
+            result += [f"{q},worst" for q in ("480p", "360p", "160p") if self.resolution(q) < chosen]
+        return result
+
+    def admit(self, channelName, quality, qualities):
+        best = None
+        for candidate in self.candidates(quality, qualities):
+            rate = self.bytesPerSecond(candidate)
+            size = int(rate * ExpectedStreamHours * 3600)
+            for libraryPath in self.libraries():
+                # file and segments write a temporary copy to DestinationPath first
+                paths = [libraryPath] if RecordingMode == "pipe" else [DestinationPath, libraryPath]
+                needs = {}
+                for path in paths:
+                    needs[self.device(path)] = needs.get(self.device(path), 0) + size
+                shortest = min(self.free(path, self.device(path)) - needs[self.device(path)] for path in paths)
+                if shortest >= 0:
+                    if candidate != quality or libraryPath != self.libraries()[0]:
+                        self.logger.info(f"{channelName}: recording {candidate} to {libraryPath}, not enough space for {quality} on the first choice")
+                    admission = Admission(candidate, libraryPath, needs, rate)
+                    self.admissions.add(admission)
+                    return admission
+                if best is None or shortest > best[0]:
+                    best = (shortest, candidate, libraryPath, needs, rate)
+        # nothing fits for a whole stream: record the lowest quality where most space is left, as long as MinFreeSpace is left at all
+        shortest, candidate, libraryPath, needs, rate = best
+        if shortest + max(needs.values()) <= 0:
+            return None
+        self.logger.error(f"{channelName}: only space for about {(shortest + max(needs.values())) / rate / 3600:.1f} hours of {candidate} on {libraryPath}")
+        admission = Admission(candidate, libraryPath, needs, rate)
+        self.admissions.add(admission)
+        return admission
+
+    def release(self, admission, received, seconds):
+        self.admissions.discard(admission)
+        self.observe(admission.quality, received, seconds)
+
+    def start(self, pending):
+        # pending: files still waiting for post processing, they are moved when they are done
+        self.migrations = asyncio.Queue()
+        self.task = asyncio.ensure_future(self.migrateLoop())
+        if not IngestLibraryPath or not os.path.isdir(IngestLibraryPath):
+            return
+        # finished recordings left on the ingest disk
+        for channelDir in os.scandir(IngestLibraryPath):
+            if not channelDir.is_dir():
+                continue
+            for entry in os.scandir(channelDir.path):
+                if entry.is_file() and not entry.name.endswith(".part") and entry.path not in pending:
+                    self.migrateLater(channelDir.name, entry.name.replace(" recovered.mp4", ".mp4"), entry.path)
+
+    def migrateLater(self, channelName, session, path):
+        if not IngestLibraryPath or self.migrations is None:
+            return
+        if os.path.dirname(os.path.dirname(os.path.abspath(path))) != os.path.abspath(IngestLibraryPath):
+            return
+        self.migrations.put_nowait((channelName, session, path))
+
+    async def migrateLoop(self):
+        while True:
+            channelName, session, path = await self.migrations.get()
+            target = os.path.join(VideoLibraryPath, channelName, os.path.basename(path))
+            try:
+                await runInThread(self.moveFile, path, target)
+                self.libraryIndex.moved(channelName, session, path, target)
+                self.logger.info(f"moved {path} to {target}")
+            except Exception as e:
+                self.logger.error(f"moving {path} to {target} failed: {e!r}")
+
+    def moveFile(self, source, target):
+        # runs in a thread, copies with at most MigrationBandwidth bytes per second to keep the disks usable for recordings
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if self.device(source) == self.device(os.path.dirname(target)):
+            os.replace(source, target)
+            return
+        part = target + ".part"
+        started = time.monotonic()
+        copied = 0
+        with open(source, "rb") as src, open(part, "wb") as dst:
+            while True:
+                if self.stopping:
+                    break
+                chunk = src.read(1024*1024)
+                if not chunk:
+                    break
+                dst.write(chunk)
+                copied += len(chunk)
+                if MigrationBandwidth:
+                    ahead = copied / MigrationBandwidth - (time.monotonic() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        if self.stopping:
+            os.remove(part)
+            raise RuntimeError("stopped")
+        shutil.copystat(source, part)
+        os.replace(part, target)
+        os.remove(source)
+
+    async def stop(self):
+        self.stopping = True
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+
+
+class PostProcessQueue:
+    # fixes/moves finished recordings in a few worker tasks, so the poll loop and the recordings never wait for ffmpeg.
+    # Every job is kept in a json journal until it is done, a job that failed or was running when the recorder stopped
+    # is started again from scratch on the next start (the half written output is removed first)
+    def __init__(self, journalFile, recorders, logger, libraryIndex, storage, workers = 0):
+        self.journalFile = journalFile
+        self.recorders = recorders
+        self.libraryIndex = libraryIndex
+        self.storage = storage
+        self.logger = logger
+        self.workers = workers or self.defaultWorkers()
+        self.queue = asyncio.Queue()
+        self.jobs = {}
+        self.tasks = []
+        self.stopping = False
+
+    def defaultWorkers(self) -> int:
+        # remuxing is mostly disk bound, two jobs per disk keep a disk busy without thrashing it
+        devices = set()
+        for path in (DestinationPath, VideoLibraryPath):
+            try:
+                devices.add(os.stat(path).st_dev)
+            except OSError:
+                pass
+        return max(1, min(os.cpu_count() or 1, 2 * max(1, len(devices))))
+
+    def loadJournal(self) -> list:
+        try:
+            with open(self.journalFile, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return []
+
+    def saveJournal(self):
+        tmp = self.journalFile + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(list(self.jobs.values()), f, indent=1)
+        os.replace(tmp, self.journalFile)
+
+    def submit(self, channelName, recorded_filename, processed_filename, state = "queued", session = None):
+        # session is the name of the recording in the library index, the target name if not given
+        if recorded_filename in self.jobs:
+            return
+        job = {"channel": channelName, "source": recorded_filename, "target": processed_filename, "state": state,
+               "session": session or os.path.basename(processed_filename)}
+        self.jobs[recorded_filename] = job
+        self.saveJournal()
+        self.queue.put_nowait(job)
+
+    def recover(self):
+        for job in self.loadJournal():
+            if job["state"] == "running" and os.path.exists(job["source"]) and os.path.exists(job["target"]):
+                self.logger.info(f"removing incomplete output of interrupted job {job['target']}")
+                os.remove(job["target"])
+            if os.path.exists(job["source"]):
+                self.submit(job["channel"], job["source"], job["target"], session=job.get("session"))
+        for recorder in self.recorders.values():
+            try:
+                leftovers = recorder.leftoverFiles()
+            except OSError as e:
+                recorder.logger.error(e)
+                continue
+            if leftovers:
+                recorder.logger.info("processing previously recorded files")
+            for recorded_filename, processed_filename in leftovers:
+                self.submit(recorder.username, recorded_filename, processed_filename)
+        self.saveJournal()
+
+    def start(self):
+        self.recover()
+        self.logger.info(f"post processing with {self.workers} workers, {len(self.jobs)} jobs queued")
+        self.tasks = [asyncio.ensure_future(self.worker()) for _ in range(self.workers)]
+
+    def depth(self) -> int:
+        return len(self.jobs)
+
+    async def stop(self):
+        # running jobs stay "running" in the journal and start again on the next start, their programs are stopped
+        # by executor.run. Jobs submitted after this stay queued in the journal
+        self.stopping = True
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def worker(self):
+        # stopping is checked as well, a cancel that came while a job ended does not keep the worker running
+        while not self.stopping:
+            job = await self.queue.get()
+            if self.stopping:
+                break
+            recorder = self.recorders.get(job["channel"]) or TwitchRecorder(job["channel"], self.logger, self, self.libraryIndex, self.storage)
+            job["state"] = "running"
+            self.saveJournal()
+            try:
+                await recorder.finish_recorded_file(job["source"], job["target"])
+                recorder.finalized(job["session"], job["target"])
+            except Exception as e:
+                # the file stays in recorded/ and the job in the journal, both are picked up again on the next start
+                recorder.logger.error(f"post processing of {job['source']} failed, retrying on the next start: {e!r}")
+                job["state"] = "failed"
+                self.saveJournal()
+                self.queue.task_done()
+                continue
+            del self.jobs[job["source"]]
+            self.saveJournal()
+            self.queue.task_done()
+
+
+class ProcessResult:
+    def __init__(self, returncode, stdout, stderr, seconds, timedOut):
+        self.returncode = returncode
+        self.stdout = stdout
+        # only the end of stderr is kept
+        self.stderr = stderr
+        self.seconds = seconds
+        self.timedOut = timedOut
+
+    def stderrText(self) -> str:
+        return self.stderr.decode("utf-8", errors="replace")
+
+
+class ProcessExecutor:
+    # starts every external program with an argument list (no shell) and keeps track of it, so that
+    # - at most MaxChildProcesses children run at the same time
+    # - calls with a timeout are stopped (terminate, kill after a few seconds) when it is over
+    # - stdout/stderr are read while the process runs, no pipe fills up and only the end of stderr is kept
+    # - the duration of every call is kept per name (streamlink-probe, ffmpeg-fix, ...) for the metrics
+    def __init__(self):
+        self.semaphore = None
+        self.reserveLock = None
+        self.closed = False
+        self.running = {}
+        self.timedOut = set()
+        self.stats = {}
+
+    def slots(self) -> asyncio.Semaphore:
+        # created on first use, so it belongs to the running loop
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(MaxChildProcesses)
+        return self.semaphore
+
+    async def reserve(self, count = 1):
+        # takes count slots at once, raises TimeoutError if they are not free within SlotTimeout. Only one caller
+        # collects several slots at a time, so two recordings that need streamlink and ffmpeg can not each hold one
+        # slot and wait for the other one forever
+        deadline = time.monotonic() + SlotTimeout
+        if self.reserveLock is None:
+            self.reserveLock = asyncio.Lock()
+        taken = 0
+        try:
+            self.checkOpen()
+            if count > 1 and not await acquireWithin(self.reserveLock, deadline - time.monotonic()):
+                raise self.slotTimeout()
+            try:
+                while taken < count:
+                    if not await acquireWithin(self.slots(), deadline - time.monotonic()):
+                        raise self.slotTimeout()
+                    taken += 1
+                    self.checkOpen()
+            finally:
+                if count > 1:
+                    self.reserveLock.release()
+        except BaseException:
+            self.release(taken)
+            raise
+
+    def checkOpen(self):
+        if self.closed:
+            raise OSError("the recorder is stopping, no new programs are started")
+
+    def slotTimeout(self) -> TimeoutError:
+        return TimeoutError(f"no free process slot within {SlotTimeout} seconds, {len(self.running)} programs are running")
+
+    def close(self):
+        # on shutdown: calls waiting for a slot fail instead of starting programs in the slots of stopped ones
+        self.closed = True
+
+    def release(self, count = 1):
+        # slots that were reserved but not used for a process
+        for _ in range(count):
+            self.slots().release()
+
+    def record(self, name, seconds, returncode, timedOut):
+        stat = self.stats.setdefault(name, {"calls": 0, "failures": 0, "timeouts": 0, "running": 0,
+                                            "seconds": 0.0, "maxSeconds": 0.0, "lastSeconds": 0.0})
+        stat["calls"] += 1
+        stat["failures"] += 1 if returncode != 0 else 0
+        stat["timeouts"] += 1 if timedOut else 0
+        stat["seconds"] += seconds
+        stat["maxSeconds"] = max(stat["maxSeconds"], seconds)
+        stat["lastSeconds"] = seconds
+
+    async def start(self, name, args, owner = None, reserved = False, **kwargs) -> asyncio.subprocess.Process:
+        # for long running processes whose pipes are handled by the caller, the slot is freed when the process ended.
+        # reserved: the slot was taken with reserve() before
+        if not reserved:
+            await self.reserve()
+        started = time.monotonic()
+        try:
+            proc = await asyncio.create_subprocess_exec(*args, **kwargs)
+        except BaseException:
+            self.slots().release()
+            self.record(name, time.monotonic() - started, None, False)
+            raise
+        self.running[proc] = owner
+        self.stats.setdefault(name, {"calls": 0, "failures": 0, "timeouts": 0, "running": 0,
+                                     "seconds": 0.0, "maxSeconds": 0.0, "lastSeconds": 0.0})["running"] += 1
+        asyncio.ensure_future(self.watch(name, proc, started))
+        return proc
+
+    async def watch(self, name, proc, started):
+        try:
+            await proc.wait()
+        finally:
+            self.running.pop(proc, None)
+            self.slots().release()
+            self.stats[name]["running"] -= 1
+            self.record(name, time.monotonic() - started, proc.returncode, proc in self.timedOut)
+            self.timedOut.discard(proc)
+
+    async def run(self, name, args, timeout = None, owner = None, keepStdout = True, onStdout = None, onStart = None) -> ProcessResult:
+        # runs a process to its end, onStdout gets every chunk of stdout as it arrives.
+        # With keepStdout=False only the end of stdout is kept (long running processes)
+        started = time.monotonic()
+        proc = await self.start(name, args, owner, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if onStart is not None:
+            onStart(proc)
+        stdout = bytearray()
+
+        async def readStdout():
+            while True:
+                chunk = await proc.stdout.read(65536)
+                if not chunk:
+                    return
+                stdout.extend(chunk)
+                if not keepStdout and len(stdout) > 64*1024:
+                    del stdout[:len(stdout) - 64*1024]
+                if onStdout is not None:
+                    onStdout(chunk)
+
+        stderr = asyncio.ensure_future(readTail(proc.stderr))
+        timedOut = False
+        try:
+            await asyncio.wait_for(asyncio.gather(readStdout(), proc.wait()), timeout)
+        except asyncio.TimeoutError:
+            timedOut = True
+            self.timedOut.add(proc)
+            await self.stop(proc)
+        except asyncio.CancelledError:
+            await self.stop(proc)
+            raise
+        return ProcessResult(proc.returncode, bytes(stdout), await stderr, time.monotonic() - started, timedOut)
+
+    async def stop(self, proc, grace = 5):
+        if proc.returncode is not None:
+            return
+        try:
+            proc.terminate()
+            await asyncio.wait_for(proc.wait(), grace)
+        except ProcessLookupError:
+            pass
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+
+    def terminate(self, owner = None):
+        for proc, procOwner in list(self.running.items()):
+            if (owner is None or procOwner == owner) and proc.returncode is None:
                 try:
-                    keys.append(int(key.split("p", 1)[0]))
-                    #.split("p", 1)[0] finds even stuff like p60 for 60fps
-                except Exception as e:
+                    proc.terminate()
+                except ProcessLookupError:
                     pass
-                
-            keys.sort(reverse=True)
-            for curRes in keys:
-                targetRes = int(defaultQuality.split("p", 1)[0])
-                #get the highst resolution under target in case the streamer uses some weird resolutions
-                if(targetRes > curRes): 
-                    return curRes
-                else:
+
+
+async def acquireWithin(lock, timeout) -> bool:
+    # acquires a Lock or Semaphore, False if that takes longer than timeout. asyncio.wait_for of python <= 3.11 can
+    # acquire it and drop a cancel that arrives at the same moment, asyncio.wait always passes the cancel on
+    acquire = asyncio.ensure_future(lock.acquire())
+    try:
+        await asyncio.wait([acquire], timeout=max(0, timeout))
+    except BaseException:
+        acquire.cancel()
+        await asyncio.wait([acquire])
+        if not acquire.cancelled():
+            lock.release()
+        raise
+    if not acquire.done():
+        acquire.cancel()
+        # the cancel may come too late, then it was acquired anyway
+        await asyncio.wait([acquire])
+    return not acquire.cancelled()
+
+
+async def readTail(stream, limit = 64*1024) -> bytes:
+    # reads a pipe until it is closed and keeps only the last bytes
+    data = bytearray()
+    while True:
+        chunk = await stream.read(65536)
+        if not chunk:
+            return bytes(data)
+        data.extend(chunk)
+        if len(data) > limit:
+            del data[:len(data) - limit]
+
+
+executor = ProcessExecutor()
+
+
+class ChannelStatus:
+    def __init__(self, status, title = None, qualities = None, startedAt = None):
+        self.status = status
+        self.title = title
+        # list of stream names like 720p60, None if the checker can not tell
+        self.qualities = qualities
+        # unix time the stream went live if the checker knows it, set to the time of the check otherwise
+        self.startedAt = startedAt
+
+
+# Status checkers answer "which of these channels are live" for a whole list of channels at once.
+# check() returns a dict channelName -> ChannelStatus and raises if the source is not reachable at all.
+# batchSize is the number of channels one request covers, 0 if any number fits into one request
+
+class StreamlinkStatusChecker:
+    # one streamlink --json process per channel, slow but needs nothing except streamlink. Used as fallback
+    batchSize = 1
+
+    def __init__(self, concurrency = 4):
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+    async def check(self, channelNames) -> dict:
+        results = await asyncio.gather(*(self.checkChannel(channelName) for channelName in channelNames))
+        return dict(zip(channelNames, results))
+
+    async def checkChannel(self, channelName) -> ChannelStatus:
+        args = [streamlinkBinary, "--json", f"twitch.tv/{channelName}"]
+        async with self.semaphore:
+            try:
+                result = await executor.run("streamlink-probe", args, timeout=ProbeTimeout, owner=channelName)
+                if result.timedOut:
+                    raise TimeoutError(f"no answer within {ProbeTimeout} seconds")
+                data = json.loads(result.stdout)
+            except Exception as e:
+                logging.getLogger(channelName).error(f"gathering infos via streamlink failed: {e}")
+                return ChannelStatus(TwitchResponseStatus.ERROR)
+        if "error" in data:
+            return ChannelStatus(TwitchResponseStatus.OFFLINE)
+        if len(data.get("streams", {})) == 0:
+            return ChannelStatus(TwitchResponseStatus.OFFLINE)
+        return ChannelStatus(TwitchResponseStatus.ONLINE, data["metadata"]["title"], list(data["streams"].keys()))
+
+
+class HttpJsonStatusChecker:
+    # GET <url>?channels=a,b,c answered with {"a": {"live": true, "title": "...", "qualities": ["720p60", ...], "startedAt": 1700000000}, "b": {"live": false}}
+    # channels missing in the answer are treated as not found. Handy for a local stub server or an own status service
+    batchSize = 0
+
+    def __init__(self, url, timeout = 15):
+        self.url = url
+        self.timeout = timeout
+
+    async def check(self, channelNames) -> dict:
+        import urllib.parse
+        import urllib.request
+        separator = "&" if "?" in self.url else "?"
+        url = f"{self.url}{separator}channels={urllib.parse.quote(','.join(channelNames))}"
+        data = await runInThread(httpJson, urllib.request.Request(url), self.timeout)
+        results = {}
+        for channelName in channelNames:
+            entry = data.get(channelName)
+            if entry is None:
+                results[channelName] = ChannelStatus(TwitchResponseStatus.NOT_FOUND)
+            elif entry.get("live"):
+                results[channelName] = ChannelStatus(TwitchResponseStatus.ONLINE, entry.get("title"), entry.get("qualities"), parseTimestamp(entry.get("startedAt")))
+            else:
+                results[channelName] = ChannelStatus(TwitchResponseStatus.OFFLINE)
+        return results
+
+
+class TwitchGqlStatusChecker:
+    # asks the twitch gql api for up to 100 channels per request. It does not know the qualities of a stream,
+    # streamlink picks from the fallback list of getAvailableStreamQuality when recording
+    batchSize = 100
+    query = "query($logins:[String!]){users(logins:$logins){login broadcastSettings{title} stream{id type createdAt}}}"
+
+    def __init__(self, clientId = None, timeout = 15):
+        self.clientId = clientId or TwitchClientId
+        self.timeout = timeout
+
+    async def check(self, channelNames) -> dict:
+        import urllib.request
+        results = {channelName: ChannelStatus(TwitchResponseStatus.NOT_FOUND) for channelName in channelNames}
+        for i in range(0, len(channelNames), 100):
+            batch = channelNames[i:i+100]
+            body = json.dumps({"query": self.query, "variables": {"logins": [c.lower() for c in batch]}}).encode("utf-8")
+            request = urllib.request.Request(TwitchGqlUrl, data=body, method="POST",
+                                             headers={"Client-Id": self.clientId, "Content-Type": "application/json"})
+            data = await runInThread(httpJson, request, self.timeout)
+            if data.get("errors"):
+                raise RuntimeError(f"twitch gql error: {data['errors']}")
+            byLogin = {c.lower(): c for c in batch}
+            for user in data["data"]["users"]:
+                if user is None or user["login"] not in byLogin:
                     continue
+                channelName = byLogin[user["login"]]
+                stream = user.get("stream")
+                if stream and stream.get("type") == "live":
+                    title = (user.get("broadcastSettings") or {}).get("title")
+                    results[channelName] = ChannelStatus(TwitchResponseStatus.ONLINE, title, None, parseTimestamp(stream.get("createdAt")))
+                else:
+                    results[channelName] = ChannelStatus(TwitchResponseStatus.OFFLINE)
+        return results
 
-        return "720p,480p,best"
 
-    def getPartString(self):
-        part = ""
-        destPath = os.path.join(VideoLibraryPath, self.username)
-        files = list(Path(destPath).glob(f'*{datetime.datetime.now().strftime("%Y-%m-%d")}*'))
-        if files and len(files) != 0:
-            part = f" part {len(files)+1}"
-        return part
+def createStatusChecker(name):
+    # "gql", "streamlink" or an http(s) url of a json status service
+    if name.startswith("http://") or name.startswith("https://"):
+        return HttpJsonStatusChecker(name)
+    if name == "gql":
+        return TwitchGqlStatusChecker()
+    if name == "streamlink":
+        return StreamlinkStatusChecker()
+    raise ValueError(f"unknown status checker {name}")
+
+
+def parseTimestamp(value):
+    # unix time or an iso time like 2024-01-31T18:00:00Z
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return datetime.datetime.strptime(value, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=datetime.timezone.utc).timestamp()
+    except ValueError:
+        return None
+
+
+def httpJson(request, timeout):
+    import urllib.request
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read().decode("utf-8"))
+
+
+async def runInThread(function, *args):
+    # asyncio.to_thread needs python 3.9
+    return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+
+class PollScheduler:
+    # decides when each channel is checked next. The times a channel went live are kept in a json file, so channels
+    # are checked more often around the time of day they usually start and less often the longer they were not live.
+    # A token bucket limits the requests of all channels to RequestsPerMinute
+    def __init__(self, channelNames, historyFile):
+        self.historyFile = historyFile
+        self.history = self.loadHistory()
+        self.nextCheck = {}
+        self.random = random.Random()
+        self.tokens = float(RequestsPerMinute)
+        self.lastRefill = time.monotonic()
+        for channelName in channelNames:
+            self.addChannel(channelName)
+
+    def addChannel(self, channelName):
+        self.history.setdefault(channelName, {"starts": [], "firstSeen": time.time()})
+        # spread the first checks a little, all channels are due right away
+        self.nextCheck[channelName] = time.time() + self.random.uniform(0, 2)
+
+    def removeChannel(self, channelName):
+        # the history is kept in case the channel comes back
+        self.nextCheck.pop(channelName, None)
+
+    def loadHistory(self) -> dict:
+        try:
+            with open(self.historyFile, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def saveHistory(self):
+        tmp = self.historyFile + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.history, f)
+        os.replace(tmp, self.historyFile)
+
+    def liveProbability(self, channelName, now) -> float:
+        # share of the observed days on which the channel went live within HotWindow of the current time of day
+        entry = self.history[channelName]
+        starts = entry["starts"]
+        if not starts:
+            return 0.0
+        nowMinute = self.minuteOfDay(now)
+        days = set()
+        for start in starts:
+            distance = abs(self.minuteOfDay(start) - nowMinute)
+            if min(distance, 24*60 - distance) * 60 <= HotWindow:
+                days.add(datetime.date.fromtimestamp(start))
+        # observed since the channel was added, or since the oldest start that is still kept
+        observedSince = starts[0] if len(starts) >= 60 else min(entry.get("firstSeen", starts[0]), starts[0])
+        observedDays = max(1, math.ceil((now - observedSince) / 86400))
+        return min(1.0, len(days) / observedDays)
+
+    def minuteOfDay(self, timestamp) -> int:
+        t = time.localtime(timestamp)
+        return t.tm_hour * 60 + t.tm_min
+
+    def interval(self, channelName, now) -> float:
+        probability = self.liveProbability(channelName, now)
+        if probability > 0:
+            interval = MinPollInterval + (PollInterval - MinPollInterval) * (1 - probability)
+        else:
+            # doubled for every day without a stream
+            entry = self.history[channelName]
+            dormantDays = int((now - entry.get("lastLive", entry["firstSeen"])) // 86400)
+            interval = PollInterval * 2 ** min(dormantDays, 16)
+        interval = min(MaxPollInterval, max(MinPollInterval, interval))
+        return interval * self.random.uniform(1 - PollJitter, 1 + PollJitter)
+
+    def due(self, now, exclude) -> list:
+        # most overdue first, so channels left out by the budget come first next time
+        channels = [c for c, due in self.nextCheck.items() if due <= now and c not in exclude]
+        return sorted(channels, key=lambda c: self.nextCheck[c])
+
+    def take(self, channelNames, batchSize) -> list:
+        # token bucket, RequestsPerMinute tokens refilled over a minute, one token per request
+        current = time.monotonic()
+        self.tokens = min(float(RequestsPerMinute), self.tokens + (current - self.lastRefill) * RequestsPerMinute / 60)
+        self.lastRefill = current
+        if not channelNames or self.tokens < 1:
+            return []
+        if batchSize <= 0:
+            self.tokens -= 1
+            return channelNames
+        allowed = channelNames[:int(self.tokens) * batchSize]
+        self.tokens -= math.ceil(len(allowed) / batchSize)
+        return allowed
+
+    def checked(self, channelName, now) -> float:
+        interval = self.interval(channelName, now)
+        self.nextCheck[channelName] = now + interval
+        return interval
+
+    def wentLive(self, channelName, now):
+        entry = self.history[channelName]
+        # a stream that comes back within an hour (disconnect, restart) is not a new start
+        if entry.get("lastLive", 0) < now - 3600:
+            entry["starts"] = (entry["starts"] + [now])[-60:]
+        entry["lastLive"] = now
+        self.saveHistory()
+
+    def wentOffline(self, channelName, now):
+        # the stream may come back after a disconnect, check again soon
+        self.history[channelName]["lastLive"] = now
+        if channelName in self.nextCheck:
+            self.nextCheck[channelName] = now + MinPollInterval
+        self.saveHistory()
+
+    def delay(self, channelName, seconds):
+        if channelName in self.nextCheck:
+            self.nextCheck[channelName] = time.time() + seconds
+
+
+class RecorderMetrics:
+    # counters and gauges per channel, shown by the StatusServer
+    def __init__(self):
+        self.channels = {}
+        self.startTime = time.time()
+
+    def channel(self, channelName) -> dict:
+        return self.channels.setdefault(channelName, {
+            "polls": 0, "pollSeconds": 0.0, "lastPollSeconds": None, "lastStatus": None, "nextCheck": None,
+            "recording": False, "quality": None, "liveSince": None, "recordingSince": None, "liveToRecordSeconds": None,
+            "recordings": 0, "receivedBytes": 0,
+            "remuxes": 0, "remuxSeconds": 0.0, "remuxBytes": 0, "lastRemuxSeconds": None, "lastRemuxBytesPerSecond": None})
+
+    def polled(self, channelName, seconds, status, nextCheck):
+        # seconds of the whole batch the channel was checked in
+        channel = self.channel(channelName)
+        channel["polls"] += 1
+        channel["pollSeconds"] += seconds
+        channel["lastPollSeconds"] = seconds
+        channel["lastStatus"] = status
+        channel["nextCheck"] = nextCheck
+
+    def recordingStarted(self, channelName, quality, liveSince):
+        channel = self.channel(channelName)
+        channel.update(recording=True, quality=quality, liveSince=liveSince, recordingSince=None)
+        channel["recordings"] += 1
+
+    def firstByte(self, channelName):
+        # the recording really started, time since the stream went live (or since it was seen live if unknown)
+        channel = self.channel(channelName)
+        channel["recordingSince"] = time.time()
+        if channel["liveSince"]:
+            channel["liveToRecordSeconds"] = channel["recordingSince"] - channel["liveSince"]
+
+    def received(self, channelName, count):
+        self.channel(channelName)["receivedBytes"] += count
+
+    def recordingEnded(self, channelName):
+        self.channel(channelName).update(recording=False, recordingSince=None, liveSince=None)
+
+    def remuxed(self, channelName, seconds, size):
+        channel = self.channel(channelName)
+        channel["remuxes"] += 1
+        channel["remuxSeconds"] += seconds
+        channel["remuxBytes"] += size
+        channel["lastRemuxSeconds"] = seconds
+        channel["lastRemuxBytesPerSecond"] = size / seconds if seconds > 0 else None
+
+
+metrics = RecorderMetrics()
+prometheusHelp = {
+    "streamrecorder_start_time_seconds": ("gauge", "Start of the recorder"),
+    "streamrecorder_poll_total": ("counter", "Status checks of the channel"),
+    "streamrecorder_poll_seconds_total": ("counter", "Seconds spent in status checks (of the whole batch) of the channel"),
+    "streamrecorder_poll_last_seconds": ("gauge", "Duration of the last status check of the channel"),
+    "streamrecorder_next_check_seconds": ("gauge", "Seconds until the next status check of the channel"),
+    "streamrecorder_recording": ("gauge", "1 while the channel is recorded"),
+    "streamrecorder_recordings_total": ("counter", "Recordings started for the channel"),
+    "streamrecorder_live_to_record_seconds": ("gauge", "Seconds from going live (or being seen live) to the first recorded byte of the last recording"),
+    "streamrecorder_received_bytes_total": ("counter", "Bytes received from streamlink for the channel"),
+    "streamrecorder_remux_total": ("counter", "Finished ffmpeg fix/join runs of the channel"),
+    "streamrecorder_remux_seconds_total": ("counter", "Seconds spent in ffmpeg fix/join runs of the channel"),
+    "streamrecorder_remux_bytes_total": ("counter", "Bytes written by ffmpeg fix/join runs of the channel"),
+    "streamrecorder_remux_last_bytes_per_second": ("gauge", "Throughput of the last ffmpeg fix/join run of the channel"),
+    "streamrecorder_restarts_total": ("counter", "Crashed recordings of the channel"),
+    "streamrecorder_postprocess_queue_depth": ("gauge", "Recordings waiting for or in post processing"),
+    "streamrecorder_process_calls_total": ("counter", "Finished external program calls"),
+    "streamrecorder_process_failures_total": ("counter", "External program calls that did not exit with 0"),
+    "streamrecorder_process_timeouts_total": ("counter", "External program calls stopped by their timeout"),
+    "streamrecorder_process_seconds_total": ("counter", "Seconds spent in external program calls"),
+    "streamrecorder_process_running": ("gauge", "Running external programs"),
+    "streamrecorder_disk_free_bytes": ("gauge", "Free bytes of a library/destination disk"),
+    "streamrecorder_disk_reserved_bytes": ("gauge", "Bytes reserved for running recordings"),
+}
+
+
+class StatusServer:
+    # small http server on the asyncio loop: /metrics in prometheus format, /status as json
+    def __init__(self, supervisor):
+        self.supervisor = supervisor
+        self.server = None
 
-    def loop_check(self, recorded_path, processed_path):
+    async def start(self):
+        try:
+            self.server = await asyncio.start_server(self.handle, MetricsHost, MetricsPort)
+            self.supervisor.logger.info(f"metrics on http://{MetricsHost}:{MetricsPort}/metrics and /status")
+        except OSError as e:
+            self.supervisor.logger.error(f"could not start the status server on {MetricsHost}:{MetricsPort}: {e}")
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        try:
+            requestLine = await asyncio.wait_for(reader.readline(), 10)
+            while (await asyncio.wait_for(reader.readline(), 10)) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = requestLine.decode("latin-1").split()
+            path = parts[1].split("?", 1)[0] if len(parts) > 1 else "/"
+            if path == "/metrics":
+                status, contentType, body = "200 OK", "text/plain; version=0.0.4", self.prometheus()
+            elif path == "/status":
+                status, contentType, body = "200 OK", "application/json", json.dumps(self.status(), indent=1)
+            else:
+                status, contentType, body = "404 Not Found", "text/plain", "try /metrics or /status\n"
+            data = body.encode("utf-8")
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {contentType}; charset=utf-8\r\nContent-Length: {len(data)}\r\n"
+                         f"Connection: close\r\n\r\n".encode("latin-1") + data)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def samples(self) -> list:
+        # (metric, labels, value)
+        supervisor = self.supervisor
+        now = time.time()
+        result = [("streamrecorder_start_time_seconds", "", metrics.startTime),
+                  ("streamrecorder_postprocess_queue_depth", "", supervisor.postProcessQueue.depth())]
+        for channelName in supervisor.recorders:
+            c = metrics.channel(channelName)
+            label = 'channel="' + escapeLabel(channelName) + '"'
+            result += [("streamrecorder_poll_total", label, c["polls"]),
+                       ("streamrecorder_poll_seconds_total", label, c["pollSeconds"]),
+                       ("streamrecorder_recording", label, 1 if c["recording"] else 0),
+                       ("streamrecorder_recordings_total", label, c["recordings"]),
+                       ("streamrecorder_received_bytes_total", label, c["receivedBytes"]),
+                       ("streamrecorder_remux_total", label, c["remuxes"]),
+                       ("streamrecorder_remux_seconds_total", label, c["remuxSeconds"]),
+                       ("streamrecorder_remux_bytes_total", label, c["remuxBytes"]),
+                       ("streamrecorder_restarts_total", label, supervisor.restarts.get(channelName, 0))]
+            if c["lastPollSeconds"] is not None:
+                result.append(("streamrecorder_poll_last_seconds", label, c["lastPollSeconds"]))
+            if c["nextCheck"] is not None and not c["recording"]:
+                result.append(("streamrecorder_next_check_seconds", label, max(0, c["nextCheck"] - now)))
+            if c["liveToRecordSeconds"] is not None:
+                result.append(("streamrecorder_live_to_record_seconds", label, c["liveToRecordSeconds"]))
+            if c["lastRemuxBytesPerSecond"] is not None:
+                result.append(("streamrecorder_remux_last_bytes_per_second", label, c["lastRemuxBytesPerSecond"]))
+        for name, stat in executor.stats.items():
+            label = 'program="' + escapeLabel(name) + '"'
+            result += [("streamrecorder_process_calls_total", label, stat["calls"]),
+                       ("streamrecorder_process_failures_total", label, stat["failures"]),
+                       ("streamrecorder_process_timeouts_total", label, stat["timeouts"]),
+                       ("streamrecorder_process_seconds_total", label, stat["seconds"]),
+                       ("streamrecorder_process_running", label, stat["running"])]
+        for path in {DestinationPath, VideoLibraryPath, IngestLibraryPath} - {None}:
+            try:
+                free = shutil.disk_usage(path).free
+            except OSError:
+                continue
+            result.append(("streamrecorder_disk_free_bytes", 'path="' + escapeLabel(path) + '"', free))
+        result.append(("streamrecorder_disk_reserved_bytes", "", sum(sum(a.reserved(d) for d in a.needs) for a in supervisor.storage.admissions)))
+        return result
+
+    def prometheus(self) -> str:
+        grouped = {}
+        for metric, labels, value in self.samples():
+            grouped.setdefault(metric, []).append(f"{metric}{{{labels}}} {value:.15g}" if labels else f"{metric} {value:.15g}")
+        output = []
+        for metric in sorted(grouped):
+            metricType, helpText = prometheusHelp.get(metric, ("gauge", metric))
+            output.append(f"# HELP {metric} {helpText}")
+            output.append(f"# TYPE {metric} {metricType}")
+            output += grouped[metric]
+        return "\n".join(output) + "\n"
+
+    def status(self) -> dict:
+        supervisor = self.supervisor
+        channels = {}
+        for channelName in supervisor.recorders:
+            channels[channelName] = dict(metrics.channel(channelName), restarts=supervisor.restarts.get(channelName, 0))
+        return {"startTime": metrics.startTime, "statusChecker": StatusChecker, "recordingMode": RecordingMode,
+                "channels": channels, "postProcessing": list(supervisor.postProcessQueue.jobs.values()),
+                "processes": executor.stats}
+
+
+def escapeLabel(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class RecorderSupervisor:
+    # runs all channels on one asyncio loop. One poll loop asks the status checker for all due channels at once
+    # and starts a recording task for every channel that went live. A recording that crashes is not retried for a
+    # growing delay, a crashed poll loop is restarted the same way
+    def __init__(self, channelNames, channelsFile = None):
+        self.logger = setup_logger("StreamRecorder", os.path.join(DestinationPath, "StreamRecorder.log"))
+        self.channelNames = list(channelNames)
+        # the channel list is read again when this file changes or on SIGHUP
+        self.channelsFile = channelsFile
+        self.channelsFileChanged = self.fileChanged(None)
+        self.reloadRequested = False
+        self.checker = createStatusChecker(StatusChecker)
+        self.fallbackChecker = StreamlinkStatusChecker() if StatusChecker != "streamlink" else None
+        self.scheduler = PollScheduler(channelNames, os.path.join(DestinationPath, "channelHistory.json"))
+        self.recorders = {}
+        self.libraryIndex = LibraryIndex(os.path.join(DestinationPath, "libraryIndex.json"))
+        self.storage = StorageManager(os.path.join(DestinationPath, "bitrates.json"), self.libraryIndex, self.logger)
+        self.postProcessQueue = PostProcessQueue(os.path.join(DestinationPath, "postprocess.json"), self.recorders, self.logger, self.libraryIndex, self.storage, PostProcessWorkers)
+        self.recordings = {}
+        self.statusServer = StatusServer(self)
+        self.restarts = {}
+        self.crashesInRow = {}
+        self.startedAt = {}
+        for channelName in channelNames:
+            self.createRecorder(channelName)
+
+    def createRecorder(self, channelName):
+        self.recorders[channelName] = TwitchRecorder(channelName, setup_logger(channelName,os.path.join(DestinationPath,f"{channelName}twitch-recorder.log")), self.postProcessQueue, self.libraryIndex, self.storage)
+        self.restarts.setdefault(channelName, 0)
+        self.crashesInRow.setdefault(channelName, 0)
+
+    def fileChanged(self, last):
+        # (mtime, size) of the channels file if it changed since last, else None
+        if not self.channelsFile:
+            return None
+        try:
+            st = os.stat(self.channelsFile)
+        except OSError:
+            return None
+        current = (st.st_mtime_ns, st.st_size)
+        return current if current != last else None
+
+    def requestReload(self):
+        self.reloadRequested = True
+
+    async def reloadChannels(self):
+        # new channels are checked right away, removed ones are not checked anymore. Running recordings are not touched,
+        # a removed channel keeps recording until its stream ends
+        changed = self.fileChanged(self.channelsFileChanged)
+        if not self.reloadRequested and changed is None:
+            return
+        self.reloadRequested = False
+        if changed is not None:
+            self.channelsFileChanged = changed
+        if not self.channelsFile:
+            self.logger.info("reload requested, but there is no channels file")
+            return
+        try:
+            channelNames = readChannelsFile(self.channelsFile)
+        except OSError as e:
+            self.logger.error(f"could not read {self.channelsFile}: {e}")
+            return
+        added = [c for c in channelNames if c not in self.channelNames]
+        removed = [c for c in self.channelNames if c not in channelNames]
+        for channelName in added:
+            if channelName not in self.recorders:
+                self.createRecorder(channelName)
+            await self.recorders[channelName].prepare()
+            self.scheduler.addChannel(channelName)
+        for channelName in removed:
+            self.scheduler.removeChannel(channelName)
+            if channelName in self.recordings:
+                self.recorders[channelName].logger.info(f"{channelName} was removed, the running recording continues until the stream ends")
+        self.channelNames = channelNames
+        if added or removed:
+            self.logger.info(f"channels reloaded, added: {' '.join(added) or '-'}, removed: {' '.join(removed) or '-'}")
+
+    def crashDelay(self, key):
+        # a task that ran for a long time before it crashed starts again with the short delay
+        if time.monotonic() - self.startedAt.get(key, 0) > MaxRestartDelay:
+            self.crashesInRow[key] = 0
+        self.crashesInRow[key] = self.crashesInRow.get(key, 0) + 1
+        return min(MaxRestartDelay, RestartDelay * 2 ** min(self.crashesInRow[key] - 1, 10))
+
+    def startRecording(self, channelName, status):
+        recorder = self.recorders[channelName]
+        recorder.postOfflineLog = True
+        self.startedAt[channelName] = time.monotonic()
+        task = asyncio.ensure_future(recorder.record(status))
+        task.add_done_callback(lambda t: self.recordingDone(channelName, t))
+        self.recordings[channelName] = task
+
+    def recordingDone(self, channelName, task):
+        recorder = self.recorders[channelName]
+        del self.recordings[channelName]
+        if task.cancelled():
+            recorder.logger.error("recording task was cancelled")
+            return
+        if task.exception() is None:
+            self.scheduler.wentOffline(channelName, time.time())
+            return
+        recorder.logger.error(f"recorder crashed: {task.exception()!r}")
+        self.restarts[channelName] += 1
+        delay = self.crashDelay(channelName)
+        recorder.logger.info(f"checking {channelName} again in {delay} seconds (restart {self.restarts[channelName]})")
+        self.scheduler.delay(channelName, delay)
+
+    async def checkStatus(self, channelNames) -> dict:
+        try:
+            return await self.checker.check(channelNames)
+        except Exception as e:
+            if self.fallbackChecker is None:
+                raise
+            # one streamlink process per channel, paid per channel from the request budget. Channels that do not fit
+            # get no status and stay due
+            fallbackNames = self.scheduler.take(channelNames, self.fallbackChecker.batchSize)
+            self.logger.error(f"status check failed, using streamlink for {len(fallbackNames)} of {len(channelNames)} channels: {e!r}")
+            if not fallbackNames:
+                return {}
+            return await self.fallbackChecker.check(fallbackNames)
+
+    async def pollOnce(self):
+        now = time.time()
+        due = self.scheduler.due(now, self.recordings)
+        channelNames = self.scheduler.take(due, self.checker.batchSize)
+        if not channelNames:
+            return
+        started = time.monotonic()
+        statuses = await self.checkStatus(channelNames)
+        seconds = time.monotonic() - started
+        now = time.time()
+        for channelName in channelNames:
+            if channelName not in statuses:
+                # not checked, the fallback ran out of budget
+                continue
+            status = statuses[channelName]
+            recorder = self.recorders[channelName]
+            interval = self.scheduler.checked(channelName, now)
+            metrics.polled(channelName, seconds, status.status.name if status else "ERROR", now + interval)
+            if status is None or status.status == TwitchResponseStatus.ERROR:
+                continue
+            if status.status == TwitchResponseStatus.ONLINE:
+                status.startedAt = status.startedAt or now
+                self.scheduler.wentLive(channelName, now)
+                self.startRecording(channelName, status)
+            elif status.status == TwitchResponseStatus.NOT_FOUND:
+                if recorder.postOfflineLog:
+                    recorder.logger.error("%s not found", channelName)
+                    recorder.postOfflineLog = False
+            elif recorder.postOfflineLog:
+                recorder.logger.info("%s currently offline, checking again in %d seconds. This log will not reapear to allow HDDs to spin down ", channelName, interval)
+                recorder.postOfflineLog = False
+
+    async def pollLoop(self):
         while True:
-            self.apiReturn = {}
-            status, title, quality = self.check_user()  
-            if status == TwitchResponseStatus.OFFLINE:
-                if self.postOfflineLog:
-                    self.logger.info("%s currently offline, checking again in %s seconds. This log will not reapear to allow HDDs to spin down ", self.username, self.refresh)
-                    self.postOfflineLog = False 
-                Sleep(self.refresh)
-            elif status == TwitchResponseStatus.ONLINE:
-                self.postOfflineLog = True
-                self.logger.info("%s online, stream recording in session", self.username)
-
-                filename = self.username + " - " + datetime.datetime.now() \
-                    .strftime("%Y-%m-%d") + self.getPartString() +" - " + title + ".mp4"
-
-                # clean filename from unnecessary characters
-                filename = "".join(x for x in filename if x.isalnum() or x in [" ", "-", "_", "."])
-
-                recorded_filename = os.path.join(recorded_path, filename)
-                processed_filename = os.path.join(VideoLibraryPath, self.username, filename)
-
-                # start streamlink process
-                if not os.path.isfile(streamlinkBinary):
-                    self.logger.CRITICAL("Streamlink not set")
-                args = None
-                if os.name == 'nt':
-                    args = [streamlinkBinary, "--twitch-disable-ads", "--twitch-low-latency", 
-                            "--logfile", os.path.join(DestinationPath,f'{self.username}_{datetime.datetime.now() \
-                    .strftime("%Y-%m-%d")}_streamlink.log'), 
-                            f"twitch.tv/{self.username }", quality, "-o", recorded_filename]
-                    self.logger.info(f"Start StreamLink with args:{subprocess.list2cmdline(args)}")
-                else:
-                    args = f"{streamlinkBinary} --twitch-disable-ads --twitch-low-latency " + \
-                            f"--logfile \"{os.path.join(DestinationPath,f'{self.username}_streamlink.log')}\" twitch.tv/{self.username} " + \
-                            f"{quality} -o \"{recorded_filename}\"" 
-                    self.logger.info(f"Start StreamLink with args:{args}")
-                
-                retData = subprocess.Popen(args, stdout=subprocess.PIPE, shell=True).communicate()
-                
-                if os.path.exists(recorded_filename):
-                    self.logger.info("recording stream is done, processing video file")
-                else:
-                    self.logger.error(f"recording stream failed: {retData}")
+            await self.reloadChannels()
+            await self.pollOnce()
+            await asyncio.sleep(min(5, MinPollInterval / 2))
 
-                if not os.path.exists(os.path.join(VideoLibraryPath, self.username)):
-                    os.makedirs(os.path.join(VideoLibraryPath, self.username))
-                if os.path.exists(recorded_filename) is True:
-                    self.process_recorded_file(recorded_filename, processed_filename)
-                else:
-                    self.logger.info("skip fixing, file not found")
-                    
-                self.logger.info("recording stream is done, processing video file")
-                if os.path.exists(recorded_filename) and os.path.exists(processed_filename) is False : #ffmpg failed, copy without fix
-                    shutil.move(recorded_filename, processed_filename)
+    async def superviseLoop(self):
+        while True:
+            self.startedAt["pollLoop"] = time.monotonic()
+            try:
+                await self.pollLoop()
+            except Exception as e:
+                delay = self.crashDelay("pollLoop")
+                self.logger.error(f"poll loop crashed, restarting in {delay} seconds: {e!r}")
+                await asyncio.sleep(delay)
 
-                self.logger.info("processing is done, going back to checking...")
-                Sleep(self.refresh)
+    def stop(self):
+        self.logger.info("stop requested")
+        self.stopEvent.set()
+
+    async def shutdown(self):
+        # the post processing stops first, interrupted jobs stay in the journal. Then no new programs are started and
+        # the recordings close their files (segments: the current segment) and queue their post processing,
+        # which is journaled and done on the next start
+        await self.postProcessQueue.stop()
+        executor.close()
+        for channelName in list(self.recordings):
+            self.recorders[channelName].stopRecording()
+        if self.recordings:
+            await asyncio.wait(list(self.recordings.values()), timeout=ShutdownTimeout)
+        for channelName, task in list(self.recordings.items()):
+            self.recorders[channelName].terminateProcesses()
+            task.cancel()
+        executor.terminate()
+        await self.storage.stop()
+        await self.statusServer.stop()
+        for name, stat in sorted(executor.stats.items()):
+            self.logger.info(f"{name}: {stat['calls']} calls, {stat['failures']} failed, {stat['timeouts']} timed out, "
+                             f"avg {stat['seconds'] / max(1, stat['calls']):.2f}s, max {stat['maxSeconds']:.2f}s")
+        self.logger.info("stopped")
+
+    async def run(self):
+        self.stopEvent = asyncio.Event()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                asyncio.get_running_loop().add_signal_handler(sig, self.stop)
+            except (NotImplementedError, RuntimeError):
+                # windows, SIGTERM stays with sigterm_handler
+                pass
+        if hasattr(signal, "SIGHUP"):
+            try:
+                asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, self.requestReload)
+            except (NotImplementedError, RuntimeError):
+                pass
+        for recorder in self.recorders.values():
+            await recorder.prepare()
+        self.postProcessQueue.start()
+        self.storage.start({job["target"] for job in self.postProcessQueue.jobs.values()})
+        if MetricsPort:
+            await self.statusServer.start()
+        self.logger.info(f"checking {len(self.recorders)} channels every {MinPollInterval}-{MaxPollInterval} seconds via {StatusChecker}")
+        poller = asyncio.ensure_future(self.superviseLoop())
+        await self.stopEvent.wait()
+        poller.cancel()
+        await self.shutdown()
+
+
+def listRecordings(channelNames):
+    # answered from the library index only
+    index = LibraryIndex(os.path.join(DestinationPath, "libraryIndex.json"))
+    for channelName in channelNames or sorted(index.channels):
+        print(channelName)
+        for date, sessions in sorted(index.channel(channelName).items()):
+            for session, record in sorted(sessions.items()):
+                size = sum(record["files"].values())
+                print(f"  {date}  {record['state']:<9} {size / 2**30:7.2f} GiB  {session}")
+
+
+def readChannelsFile(channelsFile) -> list:
+    # channels separated by new lines or commas, # starts a comment
+    channelNames = []
+    with open(channelsFile, "r", encoding="utf-8") as f:
+        for line in f:
+            for channelName in line.split("#", 1)[0].split(","):
+                if channelName.strip() and channelName.strip() not in channelNames:
+                    channelNames.append(channelName.strip())
+    return channelNames
 
 
 def main(argv):
-    recorderThreads = {}
-    recorders = {}
-    channelNames = DefaultChannels
+    global streamlinkBinary, ffmpegBinary
+    parser = argparse.ArgumentParser(description="Records twitch streams with streamlink")
+    parser.add_argument("channels", nargs="?", help=f"comma separated list of channels, overwrites DefaultChannels ({','.join(DefaultChannels)})")
+    parser.add_argument("--channelsFile", '-f', default=ChannelsFile, help="file with the channels (one per line or comma separated), changes are picked up while running")
+    parser.add_argument("--list", '-l', action="store_true", help="list the recordings of the channels (all channels if none given) and exit")
+    parser.add_argument("--rebuildIndex", action="store_true", help="read the library folders again instead of using the saved index")
+    parser.add_argument("--streamlink", help=f"streamlink binary, overwrites streamlinkBinary ({streamlinkBinary})")
+    parser.add_argument("--ffmpeg", help=f"ffmpeg binary, overwrites ffmpegBinary ({ffmpegBinary})")
+    args = parser.parse_args(argv)
 
-    if(IsAlreadyRunning()):
-        return -1
+    streamlinkBinary = args.streamlink or streamlinkBinary
+    ffmpegBinary = args.ffmpeg or ffmpegBinary
+
+    channelsFile = None
+    if args.channels:
+        channelNames = args.channels.split(",")
+    elif args.channelsFile:
+        channelsFile = os.path.abspath(args.channelsFile)
+        channelNames = readChannelsFile(channelsFile)
+    else:
+        channelNames = DefaultChannels
+    if args.list and not args.rebuildIndex:
+        listRecordings(args.channels.split(",") if args.channels else None)
+        return 0
 
     if not os.path.exists(VideoLibraryPath):
         os.makedirs(VideoLibraryPath)
     if not os.path.exists(DestinationPath):
         os.makedirs(DestinationPath)
+    if IngestLibraryPath and not os.path.exists(IngestLibraryPath):
+        os.makedirs(IngestLibraryPath)
+
+    if(IsAlreadyRunning()):
+        return -1
+    # after the lock, a running recorder writes the same index
+    if args.rebuildIndex:
+        index = LibraryIndex(os.path.join(DestinationPath, "libraryIndex.json"))
+        for channelName in set(channelNames) | set(index.channels):
+            index.rebuild(channelName)
+    if args.list:
+        listRecordings(args.channels.split(",") if args.channels else None)
+        return 0
     
-    if(len(argv)>=1):
-        channelNames = argv[0].split(",")
     print(f"channels to monitor: {' '.join(channelNames)}")
     
     signal.signal(signal.SIGTERM, sigterm_handler)
 
-    for channelName in channelNames:
-        recorder = TwitchRecorder(channelName, setup_logger(channelName,os.path.join(DestinationPath,f"{channelName}twitch-recorder.log")))
-        recorders[channelName] = recorder
-        recorderThreads[channelName] = createThread(recorder)
-    while True:
-        Sleep(30)
-        for channelName in channelNames:
-            if not recorderThreads[channelName].is_alive:
-                #recreate thread if it failed
-                recorderThreads[channelName] = createThread(recorders[channelName])
+    try:
+        asyncio.run(runRecorder(channelNames, channelsFile))
+    except KeyboardInterrupt:
+        os._exit(1)
+
 
+async def runRecorder(channelNames, channelsFile = None):
+    # created inside the loop, queues and semaphores of python < 3.10 belong to the loop they were created in
+    supervisor = RecorderSupervisor(channelNames, channelsFile)
+    await supervisor.run()
 
-def createThread(recorder : TwitchRecorder) -> Thread:
-    thread = Thread(target = recorder.run)
-    thread.daemon = True
-    thread.start()
-    return thread
 
 def setup_logger(logger_name, log_file, level=logging.INFO) -> logging.Logger:
+    from logging.handlers import RotatingFileHandler
     l = logging.getLogger(logger_name)
     formatter = logging.Formatter(u"%(asctime)s;%(levelname)s;%(message)s")
-    fileHandler = logging.FileHandler(log_file, mode='w',encoding='utf-8')
+    # appends and rotates, so the history survives restarts
+    fileHandler = RotatingFileHandler(log_file, mode='a', maxBytes=LogFileSize, backupCount=LogFileCount, encoding='utf-8')
     fileHandler.setFormatter(formatter)
     streamHandler = logging.StreamHandler()
     streamHandler.setFormatter(formatter)
@@ -304,31 +1793,56 @@ def ParseInt(value):
   except:
       return -1
 
-def Sleep(duration):    
-    try:
-        time.sleep(duration)
-    except KeyboardInterrupt:
-        os._exit(1)
 
-def IsAlreadyRunning():
-    processes = []
-    for p in psutil.process_iter():
-        if 'python' in p.name():
-            try:
-                cmdline= p.cmdline()
-                for arg  in cmdline:
-                    if os.path.basename(__file__) in arg:
-                        processes.append(p.pid)
-            except:
-                print("could not check commandline as this requires AdminRights")
-                return False
-    if len(processes) > 1:
+class InstanceLock:
+    # a lock on a file in the DestinationPath (flock on linux, msvcrt on windows). The os releases it when the
+    # process ends, even after a crash, so there are no stale lockfiles
+    def __init__(self, lockFile):
+        self.lockFile = lockFile
+        self.file = None
+
+    def acquire(self) -> bool:
+        self.file = open(self.lockFile, "a+")
+        try:
+            if os.name == "nt":
+                import msvcrt
+                self.file.seek(0)
+                msvcrt.locking(self.file.fileno(), msvcrt.LK_NBLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self.file.close()
+            self.file = None
+            return False
+        self.file.seek(0)
+        self.file.truncate()
+        self.file.write(str(os.getpid()))
+        self.file.flush()
         return True
-    return False
+
+    def owner(self) -> str:
+        try:
+            with open(self.lockFile, "r") as f:
+                return f.read().strip()
+        except OSError:
+            return "?"
+
+
+instanceLock = None
+
+def IsAlreadyRunning():
+    # the lock is kept until the process ends
+    global instanceLock
+    instanceLock = InstanceLock(os.path.join(DestinationPath, "StreamRecorder.lock"))
+    if instanceLock.acquire():
+        return False
+    print(f"StreamRecorder is already running for {DestinationPath} (pid {instanceLock.owner()})")
+    return True
 
 def sigterm_handler(_signo, _stack_frame):
     # Raises SystemExit(0):
     os._exit(0)
 
 if __name__ == "__main__":
-    main(sys.argv[1:])
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,512 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Runs StreamRecorder.py against simulated channels: a local status service says which channels are live, generated
+# stand-ins for streamlink and ffmpeg answer --json probes and send synthetic streams at a chosen bitrate until the
+# channel goes offline. The recorder process is sampled while it runs (cpu, memory, threads, child processes) and the
+# time from going live to the first recorded byte is measured per stream. Results are written as json.
+#
+# The stand-ins are this script called as "recorderSimulation.py fake-streamlink <workDir> ..." and
+# "recorderSimulation.py fake-ffmpeg <workDir> ...", the recorder itself runs as "recorderSimulation.py recorder <settings.json>"
+
+qualities = ["160p", "360p", "480p", "720p60", "1080p60"]
+# recorder settings of every run, a reservation of 8 hours per recording would not fit hundreds of channels on a test disk
+recorderDefaults = {"MinFreeSpace": 0, "RequestsPerMinute": 600, "MetricsPort": 0, "ShutdownTimeout": 20}
+# a transport stream packet, the synthetic streams repeat it
+packet = b"\x47\x40\x00\x10" + bytes(range(184))
+# the first packet of a stream is a null packet (ignored by players) that names channel and session, so the
+# ffmpeg stand-in knows which stream it got
+markerHeader = b"\x47\x1f\xff\x10"
+
+
+def readState(workDir: str) -> dict:
+    # live channels, written by the simulation, read by the stand-ins
+    try:
+        with open(os.path.join(workDir, "state.json"), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"channels": {}, "bitrate": 1}
+
+
+def writeState(workDir: str, state: dict):
+    # replaced in one step, the stand-ins never see a half written file
+    temp = os.path.join(workDir, "state.json.tmp")
+    with open(temp, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(temp, os.path.join(workDir, "state.json"))
+
+
+def writeEvent(workDir: str, event: dict):
+    # one short line per write, appends of all stand-ins do not mix
+    with open(os.path.join(workDir, "events.jsonl"), "a", encoding="utf-8") as f:
+        f.write(json.dumps(event) + "\n")
+
+
+def markerPacket(channelName: str, session: int) -> bytes:
+    data = json.dumps({"channel": channelName, "session": session}).encode()
+    return markerHeader + data + b"\xff" * (184 - len(data))
+
+
+def readMarker(data: bytes) -> dict:
+    if not data.startswith(markerHeader):
+        return None
+    try:
+        return json.loads(data[4:188].rstrip(b"\xff"))
+    except ValueError:
+        return None
+
+
+def firstByte(workDir: str, channelName: str, session: int):
+    # the recorder got the first byte of the stream: written to the file by streamlink or read by ffmpeg
+    writeEvent(workDir, {"event": "firstByte", "channel": channelName, "session": session, "time": time.time()})
+
+
+def fakeStreamlink(workDir: str, args: list) -> int:
+    # streamlink --json twitch.tv/<channel> or streamlink ... twitch.tv/<channel> <quality> (-o <file> | --stdout)
+    channelName = next((a.split("twitch.tv/", 1)[1] for a in args if "twitch.tv/" in a), "")
+    state = readState(workDir)
+    channel = state["channels"].get(channelName)
+    if "--json" in args:
+        if channel is None:
+            print(json.dumps({"error": "No playable streams found on this URL"}))
+        else:
+            print(json.dumps({"metadata": {"title": channel["title"]}, "streams": {q: {} for q in qualities + ["best", "worst"]}}))
+        return 0
+    if channel is None:
+        print("error: No playable streams found on this URL", file=sys.stderr)
+        return 1
+    if "--stdout" in args:
+        output = sys.stdout.buffer
+    else:
+        output = open(args[args.index("-o") + 1], "wb")
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    # bitrate in MBit/s, sent in 4 pieces per second
+    chunk = packet * max(1, int(state["bitrate"] * 1000000 / 8 / 4 / len(packet)))
+    session = channel["session"]
+    toFile = "--stdout" not in args
+    nextCheck = time.monotonic() + 1
+    try:
+        output.write(markerPacket(channelName, session))
+        while True:
+            output.write(chunk)
+            output.flush()
+            if toFile:
+                firstByte(workDir, channelName, session)
+                toFile = False
+            time.sleep(0.25)
+            if time.monotonic() >= nextCheck:
+                channel = readState(workDir)["channels"].get(channelName)
+                if channel is None or channel["session"] != session:
+                    return 0
+                nextCheck = time.monotonic() + 1
+    except (BrokenPipeError, OSError):
+        return 1
+    finally:
+        try:
+            output.close()
+        except OSError:
+            pass
+
+
+def fakeFfmpeg(workDir: str, args: list) -> int:
+    # the calls of StreamRecorder.py: fixing a file, muxing a pipe, cutting segments and joining segments
+    source = args[args.index("-i") + 1]
+    target = args[-1]
+    if "-n" in args and os.path.exists(target):
+        print(f"File '{target}' already exists. Exiting.", file=sys.stderr)
+        return 1
+    if "concat" in args:
+        folder = os.path.dirname(source)
+        with open(target, "wb") as out, open(source, "r", encoding="utf-8") as listFile:
+            for line in listFile:
+                with open(os.path.join(folder, line.split("'")[1]), "rb") as segment:
+                    shutil.copyfileobj(segment, out)
+        return 0
+    if source != "pipe:0":
+        with open(source, "rb") as f, open(target, "wb") as out:
+            shutil.copyfileobj(f, out)
+        return 0
+    data = b""
+    while len(data) < len(packet):
+        more = sys.stdin.buffer.read1(1024*1024)
+        if not more:
+            break
+        data += more
+    marker = readMarker(data)
+    if marker is not None:
+        firstByte(workDir, marker["channel"], marker["session"])
+    if "segment" in args:
+        # a new segment every -segment_time seconds, finished segments are listed like ffmpeg does
+        segmentTime = float(args[args.index("-segment_time") + 1])
+        segmentList = args[args.index("-segment_list") + 1]
+        number = 0
+        segment = open(target % number, "wb")
+        started = time.monotonic()
+        while True:
+            if data is None:
+                data = sys.stdin.buffer.read1(1024*1024)
+            if data:
+                segment.write(data)
+            if not data or time.monotonic() - started >= segmentTime:
+                segment.close()
+                with open(segmentList, "a", encoding="utf-8") as f:
+                    f.write(f"{os.path.basename(target % number)},{number * segmentTime},{(number + 1) * segmentTime}\n")
+                if not data:
+                    return 0
+                number += 1
+                segment = open(target % number, "wb")
+                started = time.monotonic()
+            data = None
+    with open(target, "wb") as out:
+        out.write(data)
+        shutil.copyfileobj(sys.stdin.buffer, out)
+    return 0
+
+
+def runRecorder(settingsFile: str) -> int:
+    # the recorder with the settings of the simulation, like StreamRecorder.py with its global variables changed
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    try:
+        import StreamRecorder
+    except ImportError:
+        raise ImportError('StreamRecorder needs to be in the same folder or in an importable path!')
+    with open(settingsFile, "r", encoding="utf-8") as f:
+        settings = json.load(f)
+    for name, value in settings["globals"].items():
+        if not hasattr(StreamRecorder, name):
+            raise ValueError(f"StreamRecorder has no setting {name}")
+        setattr(StreamRecorder, name, value)
+    return StreamRecorder.main(settings["argv"])
+
+
+def writeWrapper(binDir: str, name: str, workDir: str) -> str:
+    # an executable that calls this script as stand-in, StreamRecorder.py starts it like the real program
+    script = os.path.abspath(__file__)
+    if os.name == "nt":
+        path = os.path.join(binDir, f"{name}.cmd")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(f'@"{sys.executable}" "{script}" fake-{name} "{workDir}" %*\n')
+        return path
+    path = os.path.join(binDir, name)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(f'#!/bin/sh\nexec "{sys.executable}" "{script}" fake-{name} "{workDir}" "$@"\n')
+    os.chmod(path, 0o755)
+    return path
+
+
+class Schedule:
+    # live and offline times of every channel, the same seed gives the same schedule
+    def __init__(self, channelNames: list, duration: float, liveSeconds: float, offlineSeconds: float, seed: int):
+        rng = random.Random(seed)
+        self.sessions = []
+        for channelName in channelNames:
+            # some channels are already live at the start
+            at = -rng.expovariate(1 / liveSeconds) if rng.random() < liveSeconds / (liveSeconds + offlineSeconds) else rng.expovariate(1 / offlineSeconds)
+            while at < duration:
+                length = max(10.0, rng.expovariate(1 / liveSeconds))
+                self.sessions.append({"channel": channelName, "session": len(self.sessions), "start": at, "end": at + length})
+                at += length + max(10.0, rng.expovariate(1 / offlineSeconds))
+
+    def live(self, elapsed: float) -> dict:
+        return {s["channel"]: s for s in self.sessions if s["start"] <= elapsed < s["end"]}
+
+
+class StatusService:
+    # answers the HttpJsonStatusChecker of the recorder from the current state
+    def __init__(self, workDir: str):
+        self.workDir = workDir
+        self.requests = 0
+        self.channelsChecked = 0
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+                channelNames = query.get("channels", [""])[0].split(",")
+                live = service.state["channels"]
+                service.requests += 1
+                service.channelsChecked += len(channelNames)
+                body = {}
+                for channelName in channelNames:
+                    channel = live.get(channelName)
+                    body[channelName] = {"live": False} if channel is None else \
+                        {"live": True, "title": channel["title"], "qualities": qualities, "startedAt": channel["startedAt"]}
+                data = json.dumps(body).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.state = {"channels": {}}
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_port}/status"
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def readProcessStats(pid: int) -> dict:
+    # cpu seconds (own and of finished children), memory, threads and running child processes of a process.
+    # /proc on linux, psutil elsewhere if installed
+    try:
+        with open(f"/proc/{pid}/stat", "r") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        ticks = os.sysconf("SC_CLK_TCK")
+        return {"cpu": (int(fields[11]) + int(fields[12])) / ticks, "childrenCpu": (int(fields[13]) + int(fields[14])) / ticks,
+                "rss": int(fields[21]) * os.sysconf("SC_PAGE_SIZE"), "threads": int(fields[17]), "processes": len(descendants(pid))}
+    except (OSError, IndexError, ValueError):
+        pass
+    try:
+        import psutil
+        process = psutil.Process(pid)
+        times = process.cpu_times()
+        return {"cpu": times.user + times.system, "childrenCpu": times.children_user + times.children_system,
+                "rss": process.memory_info().rss, "threads": process.num_threads(), "processes": len(process.children(recursive=True))}
+    except Exception:
+        return None
+
+
+def descendants(pid: int) -> list:
+    parents = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", "r") as f:
+                parents.setdefault(int(f.read().rsplit(")", 1)[1].split()[1]), []).append(int(entry))
+        except (OSError, IndexError, ValueError):
+            continue
+    found = []
+    todo = [pid]
+    while todo:
+        children = parents.get(todo.pop(), [])
+        found += children
+        todo += children
+    return found
+
+
+def percentile(values: list, p: float):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def summarize(schedule: Schedule, workDir: str, elapsed: float) -> dict:
+    # the first byte of a stream that reached the recorder counts, later ones are restarts after a crash or reload
+    recorded = {}
+    try:
+        with open(os.path.join(workDir, "events.jsonl"), "r", encoding="utf-8") as f:
+            for line in f:
+                event = json.loads(line)
+                if event["event"] == "firstByte" and event["session"] not in recorded:
+                    recorded[event["session"]] = event["time"]
+    except (OSError, ValueError):
+        pass
+    latencies = []
+    missed = 0
+    waiting = 0
+    streams = 0
+    for s in schedule.sessions:
+        if "startedAt" not in s:
+            continue
+        streams += 1
+        if s["session"] in recorded:
+            latencies.append(recorded[s["session"]] - s["startedAt"])
+        elif s["end"] <= elapsed:
+            missed += 1
+        else:
+            waiting += 1
+    return {"streams": streams, "recorded": len(latencies), "missed": missed, "notYetRecorded": waiting,
+            "latency": {"min": min(latencies, default=None), "avg": sum(latencies) / len(latencies) if latencies else None,
+                        "p50": percentile(latencies, 50), "p95": percentile(latencies, 95), "max": max(latencies, default=None)}}
+
+
+def checkShutdown(workDir: str, shutdownSeconds: float, shutdownTimeout: float) -> dict:
+    # after SIGTERM the recorder has to end within ShutdownTimeout, and every recording is either finished in the
+    # library or still in recorded/ with a job in the post processing journal (joined or fixed on the next start)
+    try:
+        with open(os.path.join(workDir, "dest", "postprocess.json"), "r", encoding="utf-8") as f:
+            journaled = {job["source"] for job in json.load(f)}
+    except (OSError, ValueError):
+        journaled = set()
+    recordedRoot = os.path.join(workDir, "dest", "recorded")
+    pending = []
+    for channelName in os.listdir(recordedRoot) if os.path.isdir(recordedRoot) else []:
+        pending += [os.path.join(recordedRoot, channelName, name) for name in os.listdir(os.path.join(recordedRoot, channelName))]
+    finished = sum(len([f for f in files if f.endswith(".mp4")]) for _, _, files in os.walk(os.path.join(workDir, "library")))
+    lost = sorted(os.path.relpath(path, recordedRoot) for path in pending if path not in journaled)
+    inTime = shutdownSeconds <= shutdownTimeout
+    return {"seconds": shutdownSeconds, "timeout": shutdownTimeout, "inTime": inTime, "finished": finished,
+            "journaled": len(pending) - len(lost), "lost": lost, "ok": inTime and not lost}
+
+
+def simulate(args, workDir: str) -> dict:
+    channelNames = [f"simchannel{i:04}" for i in range(args.channels)]
+    schedule = Schedule(channelNames, args.duration, args.liveSeconds, args.offlineSeconds, args.seed)
+    binDir = os.path.join(workDir, "bin")
+    os.makedirs(binDir, exist_ok=True)
+    service = StatusService(workDir)
+    channelsFile = os.path.join(workDir, "channels.txt")
+    with open(channelsFile, "w", encoding="utf-8") as f:
+        f.write("\n".join(channelNames) + "\n")
+
+    state = {"channels": {}, "bitrate": args.bitrate}
+    writeState(workDir, state)
+    service.state = state
+    recorderGlobals = dict(recorderDefaults)
+    recorderGlobals.update({"DestinationPath": os.path.join(workDir, "dest"), "VideoLibraryPath": os.path.join(workDir, "library"),
+                            "StatusChecker": service.url, "RecordingMode": args.mode, "PollInterval": args.pollInterval,
+                            "MinPollInterval": args.pollInterval, "MaxPollInterval": max(120, args.pollInterval),
+                            "ExpectedStreamHours": max(args.duration, args.liveSeconds) / 3600,
+                            "QualityBitrates": {q.split("p")[0] + "p": args.bitrate for q in qualities}})
+    for setting in args.set or []:
+        name, value = setting.split("=", 1)
+        try:
+            recorderGlobals[name] = json.loads(value)
+        except ValueError:
+            recorderGlobals[name] = value
+    settingsFile = os.path.join(workDir, "settings.json")
+    with open(settingsFile, "w", encoding="utf-8") as f:
+        json.dump({"globals": recorderGlobals, "argv": ["--channelsFile", channelsFile, "--streamlink", writeWrapper(binDir, "streamlink", workDir),
+                                                        "--ffmpeg", writeWrapper(binDir, "ffmpeg", workDir)]}, f, indent=2)
+
+    output = None if args.verbose else subprocess.DEVNULL
+    recorder = subprocess.Popen([sys.executable, os.path.abspath(__file__), "recorder", settingsFile], stdout=output, stderr=output)
+    started = time.time()
+    samples = []
+    nextSample = 0.0
+    nextReport = 10.0
+    sessions = {}
+    while True:
+        elapsed = time.time() - started
+        if elapsed >= args.duration or recorder.poll() is not None:
+            break
+        live = schedule.live(elapsed)
+        if live.keys() != sessions.keys() or any(sessions[c] != live[c]["session"] for c in live):
+            # streams live before the recorder started count from its start
+            for s in live.values():
+                s.setdefault("startedAt", started + max(0.0, s["start"]))
+            state = {"channels": {c: {"session": s["session"], "title": f"simulated stream {s['session']}", "startedAt": s["startedAt"]}
+                                  for c, s in live.items()}, "bitrate": args.bitrate}
+            writeState(workDir, state)
+            service.state = state
+            sessions = {c: s["session"] for c, s in live.items()}
+        if elapsed >= nextSample:
+            stats = readProcessStats(recorder.pid)
+            if stats is not None:
+                stats.update({"time": elapsed, "live": len(live)})
+                samples.append(stats)
+            nextSample += args.sampleInterval
+        if elapsed >= nextReport:
+            last = samples[-1] if samples else {}
+            print(f"{elapsed:6.0f}s  live {len(live):4}  processes {last.get('processes', '?'):>4}  threads {last.get('threads', '?'):>4}  "
+                  f"rss {last.get('rss', 0) / 2**20:7.1f} MiB  cpu {last.get('cpu', 0):7.2f}s", file=sys.stderr)
+            nextReport += 10
+        time.sleep(0.2)
+
+    summary = summarize(schedule, workDir, time.time() - started)
+    stopping = time.time()
+    if recorder.poll() is None:
+        recorder.terminate()
+        try:
+            recorder.wait(recorderGlobals["ShutdownTimeout"] + 10)
+        except subprocess.TimeoutExpired:
+            recorder.kill()
+            recorder.wait()
+    shutdown = time.time() - stopping
+    service.stop()
+
+    runtime = samples[-1]["time"] - samples[0]["time"] if len(samples) > 1 else 0
+    report = {"recorder": {"exitCode": recorder.returncode, "shutdownSeconds": shutdown},
+              "statusRequests": service.requests, "channelsChecked": service.channelsChecked}
+    report.update(summary)
+    report["shutdown"] = checkShutdown(workDir, shutdown, recorderGlobals["ShutdownTimeout"])
+    if samples:
+        report["usage"] = {"cpuSeconds": samples[-1]["cpu"], "cpuPercent": 100 * (samples[-1]["cpu"] - samples[0]["cpu"]) / runtime if runtime else None,
+                           "childrenCpuSeconds": samples[-1]["childrenCpu"],
+                           "rssMaxMiB": max(s["rss"] for s in samples) / 2**20, "rssAvgMiB": sum(s["rss"] for s in samples) / len(samples) / 2**20,
+                           "threadsMax": max(s["threads"] for s in samples), "processesMax": max(s["processes"] for s in samples),
+                           "processesAvg": sum(s["processes"] for s in samples) / len(samples), "liveMax": max(s["live"] for s in samples)}
+    if args.samples:
+        report["samples"] = samples
+    return report
+
+
+def main() -> int:
+    # the stand-ins and the recorder are started with a role as first argument
+    if len(sys.argv) > 2 and sys.argv[1] == "fake-streamlink":
+        return fakeStreamlink(sys.argv[2], sys.argv[3:])
+    if len(sys.argv) > 2 and sys.argv[1] == "fake-ffmpeg":
+        return fakeFfmpeg(sys.argv[2], sys.argv[3:])
+    if len(sys.argv) > 2 and sys.argv[1] == "recorder":
+        return runRecorder(sys.argv[2])
+
+    parser = argparse.ArgumentParser(description="Runs StreamRecorder.py against simulated channels and prints cpu, memory, process counts and start latency as json")
+    parser.add_argument("--channels", '-c', type=int, default=200, help="number of simulated channels")
+    parser.add_argument("--duration", '-d', type=float, default=300, help="seconds to run")
+    parser.add_argument("--mode", '-m', choices=["file", "pipe", "segments"], default="file", help="RecordingMode of the recorder")
+    parser.add_argument("--bitrate", '-b', type=float, default=0.25, help="MBit/s of every simulated stream")
+    parser.add_argument("--liveSeconds", type=float, default=120, help="average length of a stream")
+    parser.add_argument("--offlineSeconds", type=float, default=180, help="average time between streams of a channel")
+    parser.add_argument("--pollInterval", type=float, default=10, help="PollInterval and MinPollInterval of the recorder")
+    parser.add_argument("--seed", type=int, default=1, help="same seed and channels give the same live times")
+    parser.add_argument("--set", action="append", help="change a global variable of the recorder, e.g. --set MaxChildProcesses=512 (value as json)")
+    parser.add_argument("--sampleInterval", type=float, default=1, help="seconds between measurements of the recorder process")
+    parser.add_argument("--samples", action="store_true", help="include every measurement in the results")
+    parser.add_argument("--workDir", '-w', help="folder for recordings and logs (default: a temporary folder, deleted afterwards)")
+    parser.add_argument("--output", '-o', help="write the json results to this file instead of stdout")
+    parser.add_argument("--verbose", '-v', action="store_true", help="show the output of the recorder")
+    parser.add_argument("--check", action="store_true", help="exit with 1 if the recorder did not stop within ShutdownTimeout after SIGTERM or left recordings neither finished nor journaled")
+    args = parser.parse_args()
+
+    workDir = os.path.abspath(args.workDir) if args.workDir else tempfile.mkdtemp(prefix="recorderSimulation")
+    os.makedirs(workDir, exist_ok=True)
+    try:
+        results = simulate(args, workDir)
+    finally:
+        if not args.workDir:
+            shutil.rmtree(workDir, ignore_errors=True)
+
+    report = {"meta": {"channels": args.channels, "duration": args.duration, "mode": args.mode, "bitrate": args.bitrate,
+                       "liveSeconds": args.liveSeconds, "offlineSeconds": args.offlineSeconds, "pollInterval": args.pollInterval,
+                       "seed": args.seed, "set": args.set or [], "python": platform.python_version(), "platform": platform.platform(),
+                       "cpus": os.cpu_count(), "time": time.strftime("%Y-%m-%dT%H:%M:%S")},
+              "results": results}
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.check and not results["shutdown"]["ok"]:
+        print(f"shutdown check failed: {json.dumps(results['shutdown'])}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())